@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+'''
+Micro-benchmark of the pileup bases tokenizer against the old clean() loop
+'''
+
+import os
+import re
+import sys
+import random
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'main'))
+import bases
+import synth
+
+def clean(reads):
+  """The regex and slicing clean() that callReads and callReadsFromFile
+  used before bases.countBases, kept here as the baseline"""
+
+  reads = re.sub(r"[$*<>]|\^.", "", reads)
+
+  while(1):
+    match = re.search(r"[+-](\d+)", reads)
+    if not match:
+      break
+
+    num = int(match.group(1))
+    startIndex = reads.find(match.group(0))
+    endIndex = startIndex + 1 + len(match.group(1)) + num
+    reads = reads[0:startIndex] + reads[endIndex:]
+
+  return reads
+
+def countClean(reads, nBase, mBase):
+  reads = clean(reads.upper())
+  n = reads.count(nBase)
+  m = reads.count(mBase)
+  return n, m, len(reads) - n - m
+
+def loadPileup(pileupFileName, minDepth, limit):
+  """Takes the bases column of the deepest-covered lines of a real pileup"""
+  columns = []
+
+  with open(pileupFileName) as pileup:
+    for line in pileup:
+      row = line.split('\t')
+      if int(row[3]) >= minDepth:
+        columns.append(row[4])
+        if len(columns) >= limit:
+          break
+
+  return columns
+
+def bench(columns, repeat):
+  for column in columns:
+    if countClean(column, 'A', 'C') != bases.countBases(column, 'A', 'C'):
+      raise ValueError("Counts differ for " + column)
+
+  old = min(timeit.repeat(lambda: [countClean(c, 'A', 'C') for c in columns], number=1, repeat=repeat))
+  new = min(timeit.repeat(lambda: [bases.countBases(c, 'A', 'C') for c in columns], number=1, repeat=repeat))
+
+  return old, new
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("-p", "--pileup", help="take bases columns from this pileup file instead of generating them")
+  parser.add_argument("-d", "--minDepth", type=int, default=200, help="only use pileup lines with at least this depth")
+  parser.add_argument("-n", "--lines", type=int, default=2000, help="number of bases columns to time")
+  parser.add_argument("-r", "--repeat", type=int, default=5, help="timing repeats, best is reported")
+  args = parser.parse_args()
+
+  if args.pileup:
+    sets = [("pileup depth >= {}".format(args.minDepth), loadPileup(args.pileup, args.minDepth, args.lines))]
+  else:
+    rand = random.Random(0)
+    sets = []
+    for depth, indelRate in ((50, 0.05), (500, 0.05), (2000, 0.05), (2000, 0.3)):
+      sets.append(("depth {} indels {:.0%}".format(depth, indelRate), [synth.makeColumn(rand, depth, indelRate) for i in range(args.lines / 10)]))
+
+  print '\t'.join(("Set", "Columns", "clean (s)", "countBases (s)", "Speedup"))
+  for name, columns in sets:
+    old, new = bench(columns, args.repeat)
+    print '\t'.join((name, str(len(columns)), "{:.4f}".format(old), "{:.4f}".format(new), "{:.1f}x".format(old / new)))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+'''
+Benchmark of the transition cut search in predict across bin sizes
+'''
+
+import os
+import sys
+import random
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'main'))
+import predict
+import siteStore
+
+def findBestCut(sequence, oldPred, newPred):
+  """The findBestCut that rescanned both sides of every candidate cut,
+  kept here as the baseline"""
+  bestCut = 0
+  bestWrong = len(sequence) + 1
+
+  for i in range(len(sequence)):
+    wrong = predict.callWrong(sequence[:i], oldPred) + predict.callWrong(sequence[i:], newPred)
+
+    if wrong < bestWrong:
+      bestCut = i
+      bestWrong = wrong
+
+  return bestCut
+
+def makeTransition(rand, length, oldPred, newPred, error):
+  """A window of sites that switches from oldPred to newPred somewhere
+  in the middle, with a fraction of miscalled sites"""
+  cut = rand.randint(0, length)
+  window = siteStore.Sites()
+
+  for i in range(length):
+    site = oldPred if i < cut else newPred
+    if site == 'H' or rand.random() < error:
+      site = rand.choice('NMH')
+    window.append(site, i)
+
+  return window
+
+def bench(windows, repeat):
+  for window, oldPred, newPred in windows:
+    if findBestCut(window, oldPred, newPred) != predict.findBestCut(window, oldPred, newPred):
+      raise ValueError("Cuts differ")
+
+  old = min(timeit.repeat(lambda: [findBestCut(*w) for w in windows], number=1, repeat=repeat))
+  new = min(timeit.repeat(lambda: [predict.findBestCut(*w) for w in windows], number=1, repeat=repeat))
+
+  return old, new
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("-b", "--binSizes", type=int, nargs="+", default=[50, 100, 200, 500, 1000, 2000], help="bin sizes to time")
+  parser.add_argument("-n", "--windows", type=int, default=20, help="transition windows per bin size")
+  parser.add_argument("-r", "--repeat", type=int, default=3, help="timing repeats, best is reported")
+  args = parser.parse_args()
+
+  rand = random.Random(0)
+  transitions = (('N', 'M'), ('M', 'N'), ('N', 'H'), ('H', 'M'))
+
+  print '\t'.join(("Bin size", "Windows", "Rescan (s)", "Running count (s)", "Speedup"))
+  for binSize in args.binSizes:
+    windows = []
+    for i in range(args.windows):
+      oldPred, newPred = transitions[i % len(transitions)]
+      windows.append((makeTransition(rand, binSize, oldPred, newPred, 0.1), oldPred, newPred))
+
+    old, new = bench(windows, args.repeat)
+    print '\t'.join((str(binSize), str(len(windows)), "{:.4f}".format(old), "{:.4f}".format(new), "{:.1f}x".format(old / new)))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+'''
+Throughput of the records block parsers against the csv.reader and int()
+row loops they replaced, on synthetic called reads, mutations and pileups
+'''
+
+import os
+import sys
+import csv
+import random
+import shutil
+import argparse
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'main'))
+import records
+import synth
+
+def csvCalls(fileName):
+  """The old loop: each row split by csv.reader and its numbers int()ed"""
+  with open(fileName) as inFile:
+    return [(row[0], int(row[1]), row[2], int(row[3]), int(row[4]), int(row[5])) for row in csv.reader(inFile, delimiter='\t')]
+
+def csvMutations(fileName):
+  with open(fileName) as inFile:
+    return [(row[3], int(row[4]), row[5], row[6]) for row in csv.reader(inFile, delimiter='\t')]
+
+def csvPileup(fileName):
+  with open(fileName) as inFile:
+    return [(row[0].split("_")[1], int(row[1]), int(row[3]), row[4], row[5]) for row in csv.reader(inFile, delimiter='\t')]
+
+def blockRows(reader, fileName):
+  """Rows parsed by a records reader"""
+  with open(fileName) as inFile:
+    return sum(len(block.pos) for block in reader(inFile))
+
+def bench(fileName, old, reader, repeat):
+  rows = len(old(fileName))
+  if blockRows(reader, fileName) != rows:
+    raise ValueError("Row counts differ for " + fileName)
+
+  oldTime = min(timeit.repeat(lambda: old(fileName), number=1, repeat=repeat))
+  newTime = min(timeit.repeat(lambda: blockRows(reader, fileName), number=1, repeat=repeat))
+
+  return rows, oldTime, newTime
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("-s", "--sites", type=int, default=100000, help="sites per chromosome")
+  parser.add_argument("-r", "--repeat", type=int, default=3, help="timing repeats, best is reported")
+  args = parser.parse_args()
+
+  workDir = tempfile.mkdtemp()
+  try:
+    rand = random.Random(0)
+    sites = synth.makeSites(rand, args.sites)
+    synth.writeMutations(os.path.join(workDir, "mutations.txt"), sites)
+    synth.writePileup(os.path.join(workDir, "reads.pileup"), rand, sites)
+    synth.writeCalls(os.path.join(workDir, "calls.txt"), rand, sites, synth.makeRegions(rand, sites, 3))
+
+    sets = (
+      ("called reads", "calls.txt", csvCalls, records.readCalls),
+      ("mutations", "mutations.txt", csvMutations, records.readMutations),
+      ("pileup", "reads.pileup", csvPileup, records.readPileup),
+    )
+
+    print '\t'.join(("File", "Rows", "csv (rows/s)", "records (rows/s)", "Speedup"))
+    for name, fileName, old, reader in sets:
+      rows, oldTime, newTime = bench(os.path.join(workDir, fileName), old, reader, args.repeat)
+      print '\t'.join((name, str(rows), "{:,.0f}".format(rows / oldTime), "{:,.0f}".format(rows / newTime), "{:.1f}x".format(oldTime / newTime)))
+  finally:
+    shutil.rmtree(workDir)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+'''
+Wall time and peak memory of each pipeline stage on seeded synthetic inputs,
+at small, medium and genome scale, saved as JSON for comparing runs
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import traceback
+from multiprocessing import Process, Pipe
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'main'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'stats'))
+import predict
+import filterReads
+import filterPileup
+import fixedSites
+import callReadsFromFile
+import gatherStats
+import synth
+
+#Sites per chromosome, gatherStats samples (which are also the fixedSites
+#reads files) and crossovers per chromosome for each scale. Genome scale is
+#about the number of SNPs between N2 and a wild isolate
+SCALES = {
+  "small": {"sites": 1000, "samples": 2, "crossovers": 2},
+  "medium": {"sites": 20000, "samples": 4, "crossovers": 3},
+  "genome": {"sites": 100000, "samples": 8, "crossovers": 4},
+}
+SCALE_ORDER = ("small", "medium", "genome")
+
+BIN_SIZE = 100
+
+def makeInputs(workDir, scale, seed):
+  """Writes the synthetic inputs for a scale into workDir"""
+  params = SCALES[scale]
+  rand = random.Random(seed)
+  sites = synth.makeSites(rand, params["sites"])
+
+  synth.writeMutations(os.path.join(workDir, "mutations.txt"), sites)
+  synth.writeSitesFile(os.path.join(workDir, "sites.txt"), sites)
+  synth.writePileup(os.path.join(workDir, "reads.pileup"), rand, sites)
+  synth.writeFilter(os.path.join(workDir, "filter.txt"), rand, sites, 0.8)
+  synth.writeCalls(os.path.join(workDir, "S_calledReads.filtered.txt"), rand, sites, synth.makeRegions(rand, sites, params["crossovers"]))
+  synth.writeStatsLayout(os.path.join(workDir, "stats"), rand, sites, params["samples"], params["crossovers"])
+
+def runCallReads(workDir):
+  callReadsFromFile.callReads("mutations.txt", "reads.pileup", "calls.out.txt")
+
+def runFilterPileup(workDir):
+  filterPileup.filterReads("reads.pileup", "filter.txt", "pileup.filtered.txt")
+
+def runFilterReads(workDir):
+  filterReads.filterReads("S_calledReads.filtered.txt", "filter.txt", "calls.filtered.txt")
+
+def runPredict(workDir):
+  predict.predict("S_calledReads.filtered.txt", "S.pred.txt", "S", BIN_SIZE)
+
+def runFixedSites(workDir):
+  fixedSites.findFixed("sites.txt", os.path.join("stats", "calls"))
+
+def runGatherStats(workDir):
+  os.chdir("stats")
+  gatherStats.gather("bc.txt", "stats.out.txt")
+
+#Each stage with the function that runs it in the work directory and the
+#inputs its rows and bytes are counted from
+STAGES = (
+  ("callReadsFromFile", runCallReads, ("reads.pileup",)),
+  ("filterPileup", runFilterPileup, ("reads.pileup",)),
+  ("filterReads", runFilterReads, ("S_calledReads.filtered.txt",)),
+  ("predict", runPredict, ("S_calledReads.filtered.txt",)),
+  ("fixedSites", runFixedSites, (os.path.join("stats", "calls"),)),
+  ("gatherStats", runGatherStats, (os.path.join("stats", "calls"), os.path.join("stats", "piles"))),
+)
+
+def inputFiles(workDir, inputs):
+  fileNames = []
+  for name in inputs:
+    path = os.path.join(workDir, name)
+    if os.path.isdir(path):
+      fileNames.extend(os.path.join(path, fileName) for fileName in sorted(os.listdir(path)))
+    else:
+      fileNames.append(path)
+
+  return fileNames
+
+def countInputs(workDir, inputs):
+  """Returns the number of lines and bytes in a stage's inputs"""
+  rows = 0
+  size = 0
+
+  for fileName in inputFiles(workDir, inputs):
+    size = size + os.path.getsize(fileName)
+    with open(fileName) as inFile:
+      for line in inFile:
+        rows = rows + 1
+
+  return rows, size
+
+def timeStage(run, workDir, conn):
+  """Runs a stage in this (forked) process and sends back its seconds, the
+  peak RSS and how far the peak rose above the RSS at the start, in KB"""
+  try:
+    os.chdir(workDir)
+    sys.stdout = open(os.devnull, 'w')
+
+    startRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    run(workDir)
+    seconds = time.time() - start
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    conn.send((seconds, peakRss, peakRss - startRss, None))
+  except Exception:
+    conn.send((None, None, None, traceback.format_exc()))
+  finally:
+    conn.close()
+
+def benchStage(run, workDir, repeat):
+  """Times a stage repeat times, each in a fresh process so the peak memory
+  is the stage's own. Returns the best seconds and the largest peaks"""
+  best = None
+  peakRss = 0
+  rssGrowth = 0
+
+  for i in range(repeat):
+    parentConn, childConn = Pipe(False)
+    process = Process(target=timeStage, args=(run, workDir, childConn))
+    process.start()
+    seconds, runPeak, runGrowth, error = parentConn.recv()
+    process.join()
+
+    if error:
+      raise RuntimeError(error)
+
+    best = seconds if best is None else min(best, seconds)
+    peakRss = max(peakRss, runPeak)
+    rssGrowth = max(rssGrowth, runGrowth)
+
+  return best, peakRss, rssGrowth
+
+def bench(scales, stages, seed, repeat, workRoot):
+  results = []
+
+  for scale in scales:
+    workDir = os.path.join(workRoot, "{}.{}".format(scale, seed))
+    if not os.path.isdir(workDir):
+      os.makedirs(workDir)
+      makeInputs(workDir, scale, seed)
+
+    for name, run, inputs in STAGES:
+      if stages and name not in stages:
+        continue
+
+      rows, size = countInputs(workDir, inputs)
+      seconds, peakRss, rssGrowth = benchStage(run, workDir, repeat)
+
+      results.append({
+        "stage": name,
+        "scale": scale,
+        "seconds": seconds,
+        "rows": rows,
+        "rowsPerSecond": rows / seconds if seconds else None,
+        "inputBytes": size,
+        "peakRssKb": peakRss,
+        "rssGrowthKb": rssGrowth,
+      })
+      print '\t'.join((scale, name, str(rows), "{:.3f}".format(seconds), "{:.0f}".format(rows / seconds if seconds else 0), str(peakRss), str(rssGrowth)))
+      sys.stdout.flush()
+
+  return results
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("-s", "--scales", nargs="+", choices=SCALE_ORDER, default=["small", "medium"], help="scales to run")
+  parser.add_argument("-t", "--stages", nargs="+", choices=[name for name, run, inputs in STAGES], help="only run these stages")
+  parser.add_argument("-o", "--output", default="benchStages.json", help="the JSON file to save results to")
+  parser.add_argument("-w", "--workDir", help="keep the synthetic inputs here and reuse them on later runs")
+  parser.add_argument("-r", "--repeat", type=int, default=1, help="timing repeats, best is reported")
+  parser.add_argument("--seed", type=int, default=0, help="random seed for the synthetic inputs")
+  args = parser.parse_args()
+
+  workRoot = args.workDir or tempfile.mkdtemp(prefix="benchStages")
+  scales = [scale for scale in SCALE_ORDER if scale in args.scales]
+
+  try:
+    print '\t'.join(("Scale", "Stage", "Rows", "Seconds", "Rows/s", "Peak RSS (KB)", "RSS growth (KB)"))
+    results = bench(scales, args.stages, args.seed, args.repeat, workRoot)
+  finally:
+    if not args.workDir:
+      shutil.rmtree(workRoot)
+
+  with open(args.output, 'w') as outFile:
+    json.dump({
+      "seed": args.seed,
+      "repeat": args.repeat,
+      "binSize": BIN_SIZE,
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+      "scales": dict((scale, SCALES[scale]) for scale in scales),
+      "results": results,
+    }, outFile, indent=2, sort_keys=True)
+    outFile.write('\n')
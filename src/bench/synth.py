@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+'''
+Seeded synthetic inputs for the pipeline stages: mpileup lines, mutation
+tables, called reads files and the calls/piles/preds layout gatherStats reads
+'''
+
+import os
+import sys
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'main'))
+import predict
+
+BASES = "ACGT"
+
+def makeColumn(rand, depth, indelRate):
+  """A bases column with read starts/ends and indels at roughly the rates
+  seen in high coverage C. elegans pileups"""
+  reads = []
+
+  for i in range(depth):
+    if rand.random() < 0.02:
+      reads.append('^' + chr(rand.randint(33, 73)))
+
+    reads.append(rand.choice('..........,,,,,,,,,,AaCcGgTtN*'))
+
+    if rand.random() < indelRate:
+      length = rand.randint(1, 20)
+      reads.append(rand.choice('+-') + str(length) + ''.join(rand.choice('ACGTacgt') for j in range(length)))
+    elif rand.random() < 0.02:
+      reads.append('$')
+
+  return ''.join(reads)
+
+def makeQuals(rand, depth):
+  """Phred+33 qualities, mostly high with a tail of poor bases"""
+  return ''.join(chr(33 + (rand.randint(30, 41) if rand.random() < 0.85 else rand.randint(2, 29))) for i in range(depth))
+
+def makeDepth(rand, meanDepth):
+  """Read depth around meanDepth, with the occasional very deep site"""
+  if rand.random() < 0.01:
+    return rand.randint(meanDepth * 5, meanDepth * 20)
+  return max(0, int(rand.gauss(meanDepth, meanDepth / 3.0)))
+
+def makeSites(rand, sitesPerChrome, chromes=None):
+  """Picks sorted mutation positions along each chromosome, with the N2
+  and MY14 base at each. Returns a list of (chrome, pos, nBase, mBase)"""
+  sites = []
+
+  for chrome in chromes or sorted(predict.chromeLengths.keys()):
+    length = predict.chromeLengths[chrome]
+    for pos in sorted(rand.sample(xrange(1, length), min(sitesPerChrome, length - 1))):
+      nBase, mBase = rand.sample(BASES, 2)
+      sites.append((chrome, pos, nBase, mBase))
+
+  return sites
+
+def writeMutations(fileName, sites):
+  """A mutations table as callReads reads it, chromosome in the fourth
+  column and the N2 and MY14 bases after the position"""
+  with open(fileName, 'w') as mutFile:
+    for i, (chrome, pos, nBase, mBase) in enumerate(sites):
+      mutFile.write('\t'.join(("mut" + str(i), "snp", "MY14", chrome, str(pos), nBase, mBase)) + '\n')
+
+def writeSitesFile(fileName, sites):
+  """A candidate sites file as fixedSites reads it"""
+  with open(fileName, 'w') as sitesFile:
+    for chrome, pos, nBase, mBase in sites:
+      sitesFile.write('\t'.join(("CHROMOSOME_" + chrome, str(pos), nBase + mBase)) + '\n')
+
+def writeFilter(fileName, rand, sites, fraction):
+  """A filter file keeping about fraction of the sites, as filterPileup
+  and filterReads read it"""
+  with open(fileName, 'w') as filterFile:
+    for chrome, pos, nBase, mBase in sites:
+      if rand.random() < fraction:
+        filterFile.write(chrome + '\t' + str(pos) + '\n')
+
+def writePileup(fileName, rand, sites, meanDepth=30, coverage=0.9, indelRate=0.05, prefix="CHROMOSOME_"):
+  """An mpileup of the sites, leaving out about 1 - coverage of them the way
+  mpileup leaves out sites no read covers. Bases are mostly the N2 or MY14
+  base with read starts, ends and indels mixed in"""
+  with open(fileName, 'w') as pileFile:
+    for chrome, pos, nBase, mBase in sites:
+      if rand.random() >= coverage:
+        continue
+
+      depth = makeDepth(rand, meanDepth)
+      column = makeColumn(rand, depth, indelRate)
+
+      #Swap the reference matches for the strain bases at about the rate
+      #a mixed population would show them
+      mFraction = rand.random()
+      column = ''.join(c if c not in '.,' else (mBase if rand.random() < mFraction else nBase) for c in column)
+
+      pileFile.write('\t'.join((prefix + chrome, str(pos), nBase, str(depth), column, makeQuals(rand, depth))) + '\n')
+
+def makeRegions(rand, sites, crossovers, hetRate=0.0):
+  """Splits each chromosome's sites into crossovers + 1 regions of N or M,
+  and H at hetRate. Returns a list of (chrome, firstSite, lastSite, pred)
+  with indexes into sites"""
+  regions = []
+
+  chromeStart = 0
+  while chromeStart < len(sites):
+    chrome = sites[chromeStart][0]
+    chromeEnd = chromeStart
+    while chromeEnd < len(sites) and sites[chromeEnd][0] == chrome:
+      chromeEnd = chromeEnd + 1
+
+    count = chromeEnd - chromeStart
+    cuts = sorted(rand.sample(xrange(1, count), min(crossovers, count - 1))) if count > 1 else []
+    bounds = [0] + cuts + [count]
+
+    pred = rand.choice("NM")
+    for first, last in zip(bounds, bounds[1:]):
+      regions.append((chrome, chromeStart + first, chromeStart + last - 1, 'H' if rand.random() < hetRate else pred))
+      pred = 'M' if pred == 'N' else 'N'
+
+    chromeStart = chromeEnd
+
+  return regions
+
+def writeCalls(fileName, rand, sites, regions, unknownRate=0.3, errorRate=0.05):
+  """A called reads file following the regions, with unknownRate U sites
+  and errorRate miscalls"""
+  with open(fileName, 'w') as callFile:
+    for chrome, first, last, pred in regions:
+      for chrome, pos, nBase, mBase in sites[first:last + 1]:
+        if rand.random() < unknownRate:
+          call = 'U'
+          n = m = 0
+        else:
+          call = pred if pred != 'H' and rand.random() >= errorRate else rand.choice("NMH")
+          n = rand.randint(1, 20) if call in "NH" else 0
+          m = rand.randint(1, 20) if call in "MH" else 0
+
+        callFile.write('\t'.join((chrome, str(pos), call, str(n), str(m), str(rand.randint(0, 3)))) + '\n')
+
+def writePreds(fileName, sites, regions):
+  """A table format prediction file for the regions, the columns
+  gatherStats reads after the header"""
+  with open(fileName, 'w') as predFile:
+    predFile.write("Strain,Chromosome,Start,End,Prediction\n")
+    for chrome, first, last, pred in regions:
+      end = sites[last][1]
+      predFile.write('\t'.join((chrome, str(end), str(end), pred, str(last - first + 1))) + '\n')
+
+def writeStatsLayout(dirName, rand, sites, samples, crossovers, meanDepth=30):
+  """The calls, piles and preds directories and barcode rate file that
+  gatherStats reads from its working directory, one file each per sample.
+  Returns the barcode rate file name"""
+  for subDir in ("calls", "piles", "preds"):
+    if not os.path.isdir(os.path.join(dirName, subDir)):
+      os.makedirs(os.path.join(dirName, subDir))
+
+  bcRateFileName = os.path.join(dirName, "bc.txt")
+  with open(bcRateFileName, 'w') as bcFile:
+    for sample in range(samples):
+      name = "S{:03d}".format(sample)
+      regions = makeRegions(rand, sites, crossovers)
+      writeCalls(os.path.join(dirName, "calls", name + ".txt"), rand, sites, regions)
+      writePileup(os.path.join(dirName, "piles", name + ".pile"), rand, sites, meanDepth, indelRate=0.0, prefix="")
+      writePreds(os.path.join(dirName, "preds", name + ".pred.txt"), sites, regions)
+      bcFile.write(str(rand.uniform(0.01, 0.05)) + '\n')
+
+  return bcRateFileName
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("outDir", help="the folder to write the synthetic files to")
+  parser.add_argument("-n", "--sites", type=int, default=2000, help="mutation sites per chromosome")
+  parser.add_argument("-c", "--crossovers", type=int, default=3, help="crossovers per chromosome in the called reads")
+  parser.add_argument("-d", "--depth", type=int, default=30, help="mean pileup read depth")
+  parser.add_argument("-s", "--samples", type=int, default=3, help="samples in the gatherStats layout")
+  parser.add_argument("--seed", type=int, default=0, help="random seed")
+  args = parser.parse_args()
+
+  rand = random.Random(args.seed)
+  sites = makeSites(rand, args.sites)
+
+  if not os.path.isdir(args.outDir):
+    os.makedirs(args.outDir)
+
+  writeMutations(os.path.join(args.outDir, "mutations.txt"), sites)
+  writeSitesFile(os.path.join(args.outDir, "sites.txt"), sites)
+  writePileup(os.path.join(args.outDir, "reads.pileup"), rand, sites, args.depth)
+  writeFilter(os.path.join(args.outDir, "filter.txt"), rand, sites, 0.8)
+  writeCalls(os.path.join(args.outDir, "S_calledReads.filtered.txt"), rand, sites, makeRegions(rand, sites, args.crossovers))
+  writeStatsLayout(os.path.join(args.outDir, "stats"), rand, sites, args.samples, args.crossovers, args.depth)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+'''
+Writes JBrowse NCList tracks straight from pred files and called reads files,
+without going through GFF and flatfile-to-json.pl
+
+Each track gets tracks/<track>/<refseq>/trackData.json with the features in
+lazily loaded lf-<chunk>.json files and a feature density histogram beside
+it. A pred file makes one track, <strain>_pred_<bin>, and a called reads file
+makes one track per call, <strain>_calledReads.<call>, the names predict's
+View links and the pipeline's trackList.json use. Tracks whose source file
+hasn't changed since they were written are left alone, and sources are
+converted in parallel.
+'''
+
+import os
+import sys
+import json
+import math
+import shutil
+import argparse
+import numpy
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'main'))
+import records
+import callStore
+import predIndex
+import makeTrackList
+
+#Bump when the track layout changes so every track is rewritten
+TRACK_VERSION = 1
+
+#Where each track keeps the source file details it was written from
+STAMP_FILE = "source.json"
+
+#Top level features per lazily loaded chunk file
+CHUNK_SIZE = 5000
+
+#Histogram bins per chunk file
+HIST_CHUNK_SIZE = 10000
+
+#Most histogram bins on a chromosome
+MAX_BINS = 10000
+
+#The calls a called reads file is split into, each its own track
+CALLS = ("N", "M", "H", "U")
+
+PRED_ATTRIBUTES = ["Start", "End", "Strand", "Source", "Type", "Name", "prediction"] + [name.lower() for name in predIndex.STAT_NAMES]
+READ_ATTRIBUTES = ["Start", "End", "Strand", "Source", "Type", "Name", "call", "n2 reads", "my14 reads", "other reads"]
+
+def featureClass(attributes):
+  """An NCList class. Sublist is last so features without one can leave it off"""
+  return {"attributes": attributes + ["Sublist"], "isArrayAttr": {"Sublist": 1}}
+
+LAZY_CLASS = {"attributes": ["Start", "End", "Chunk"], "isArrayAttr": {"Sublist": 1}}
+
+def refSeqName(chrome):
+  return chrome if chrome.startswith("CHROMOSOME_") else "CHROMOSOME_" + chrome
+
+def predFeatures(predFileName):
+  """The features of a pred file's one track as {refseq: [feature]}, with
+  GFF style 1-based starts made 0-based like flatfile-to-json does"""
+  features = {}
+
+  for chrome, start, end, pred, stats in predIndex.readRegionStats(predFileName):
+    refSeq = refSeqName(chrome)
+    feature = [0, max(start - 1, 0), end, 0, "Custom", "Prediction", pred + " region", pred] + [value for name, value in stats]
+    features.setdefault(refSeq, []).append(feature)
+
+  return {predTrackName(predFileName): features}
+
+def readBlocks(callsFileName):
+  """The records.Calls blocks of a called reads file, from its binary store
+  when it has a current one. A store's blocks are views onto it, so each is
+  only good until the next is asked for"""
+  store = callStore.openCalls(callsFileName)
+  if store is not None:
+    with store:
+      for block in store.blocks():
+        yield block
+    return
+
+  with open(callsFileName) as callsFile:
+    for block in records.readCalls(callsFile):
+      yield block
+
+def readFeatures(callsFileName):
+  """The features of a called reads file's tracks, one per call, as
+  {track: {refseq: [feature]}}"""
+  tracks = dict((call, {}) for call in CALLS)
+
+  for block in readBlocks(callsFileName):
+    refSeq = refSeqName(block.chrome)
+    for pos, call, n, m, p in zip(block.pos.tolist(), block.call.tostring(), block.n.tolist(), block.m.tolist(), block.p.tolist()):
+      track = tracks.get(call)
+      if track is None:
+        continue
+
+      track.setdefault(refSeq, []).append([0, pos - 1, pos, 0, "Custom", "Call", block.chrome + ":" + str(pos), call, n, m, p])
+
+  return dict((readTrackName(callsFileName, call), track) for call, track in tracks.items())
+
+def nest(features, numAttributes):
+  """Sorts features and nests each inside the nearest feature before it that
+  contains it, returning the top level list of the NCList. A feature's
+  Sublist goes after its class number and numAttributes values"""
+  sublistIndex = numAttributes + 1
+  features.sort(key=lambda feature: (feature[1], -feature[2]))
+
+  top = []
+  #The features the next one could be inside, innermost last
+  containers = []
+  for feature in features:
+    while containers and containers[-1][2] < feature[2]:
+      containers.pop()
+
+    if containers:
+      parent = containers[-1]
+      if len(parent) <= sublistIndex:
+        parent.extend([None] * (sublistIndex + 1 - len(parent)))
+        parent[sublistIndex] = []
+      parent[sublistIndex].append(feature)
+    else:
+      top.append(feature)
+
+    containers.append(feature)
+
+  return top
+
+def histogram(features, length):
+  """Feature counts per bin, counting a feature in every bin it overlaps.
+  Returns (basesPerBin, counts)"""
+  basesPerBin = 10 ** max(0, int(math.ceil(math.log10(max(length, 1) / float(MAX_BINS)))))
+  starts = numpy.array([feature[1] for feature in features], dtype=numpy.int64) // basesPerBin
+  ends = numpy.maximum(numpy.array([feature[2] for feature in features], dtype=numpy.int64) - 1, 0) // basesPerBin
+  numBins = int(ends.max()) + 1 if len(ends) else 0
+
+  #Each feature adds one from its first bin up to its last
+  change = numpy.bincount(starts, minlength=numBins + 1) - numpy.bincount(ends + 1, minlength=numBins + 1)
+  return basesPerBin, numpy.cumsum(change)[:numBins]
+
+def writeJson(fileName, data):
+  with open(fileName, 'w') as outFile:
+    json.dump(data, outFile, separators=(',', ':'))
+
+def writeRefSeq(refSeqDir, features, attributes):
+  """Writes one chromosome of a track: the chunk files, the histogram and the
+  trackData.json pointing at them"""
+  os.makedirs(refSeqDir)
+
+  featureCount = len(features)
+  minStart = min(feature[1] for feature in features)
+  maxEnd = max(feature[2] for feature in features)
+  basesPerBin, counts = histogram(features, maxEnd)
+
+  top = nest(features, len(attributes))
+  lazy = []
+  for chunk, first in enumerate(range(0, len(top), CHUNK_SIZE)):
+    chunkFeatures = top[first:first + CHUNK_SIZE]
+    writeJson(os.path.join(refSeqDir, "lf-{}.json".format(chunk + 1)), chunkFeatures)
+    lazy.append([1, chunkFeatures[0][1], max(feature[2] for feature in chunkFeatures), chunk + 1])
+
+  for chunk, first in enumerate(range(0, len(counts), HIST_CHUNK_SIZE)):
+    writeJson(os.path.join(refSeqDir, "hist-{}-{}.json".format(basesPerBin, chunk)), counts[first:first + HIST_CHUNK_SIZE].tolist())
+
+  writeJson(os.path.join(refSeqDir, "trackData.json"), {
+    "featureCount": featureCount,
+    "formatVersion": 1,
+    "histograms": {
+      "meta": [{
+        "basesPerBin": basesPerBin,
+        "arrayParams": {"length": len(counts), "chunkSize": HIST_CHUNK_SIZE, "urlTemplate": "hist-{}-{{Chunk}}.json".format(basesPerBin)},
+      }],
+      "stats": [{"basesPerBin": basesPerBin, "max": int(counts.max()) if len(counts) else 0, "mean": float(counts.mean()) if len(counts) else 0}],
+    },
+    "intervals": {
+      "classes": [featureClass(attributes), LAZY_CLASS],
+      "lazyClass": 1,
+      "count": featureCount,
+      "minStart": minStart,
+      "maxEnd": maxEnd,
+      "nclist": lazy,
+      "urlTemplate": "lf-{Chunk}.json",
+    },
+  })
+
+def writeTrack(trackDir, refSeqs, attributes, stamp):
+  """Writes a whole track to a temporary directory, then swaps it in for the
+  old one so a browser never sees half a track"""
+  tempDir = trackDir + ".tmp"
+  if os.path.exists(tempDir):
+    shutil.rmtree(tempDir)
+  os.makedirs(tempDir)
+
+  for refSeq, features in refSeqs.items():
+    writeRefSeq(os.path.join(tempDir, refSeq), features, attributes)
+  writeJson(os.path.join(tempDir, STAMP_FILE), stamp)
+
+  if os.path.exists(trackDir):
+    shutil.rmtree(trackDir)
+  os.rename(tempDir, trackDir)
+
+def sourceStamp(sourceFileName):
+  """What a track records about its source to tell if it's current"""
+  info = os.stat(sourceFileName)
+  return {"source": os.path.abspath(sourceFileName), "mtime": info.st_mtime, "size": info.st_size, "version": TRACK_VERSION, "chunkSize": CHUNK_SIZE}
+
+def isCurrent(trackDir, stamp):
+  try:
+    with open(os.path.join(trackDir, STAMP_FILE)) as stampFile:
+      return json.load(stampFile) == stamp
+  except (IOError, ValueError):
+    return False
+
+def predTrackName(predFileName):
+  """<strain>_pred_<bin> for <strain>.pred.<bin>.txt, the name the pipeline's
+  gff tracks and predict's View links use. Other names are kept as they are"""
+  base = os.path.splitext(os.path.basename(predFileName))[0]
+  strain, pred, binSize = base.rpartition(".pred.")
+  return strain + "_pred_" + binSize if pred else base
+
+def readTrackName(callsFileName, call):
+  """<strain>_calledReads.<call> for <strain>_calledReads.txt and its
+  filtered .filtered.txt, as predict's View links name them"""
+  base = os.path.splitext(os.path.basename(callsFileName))[0]
+  if "_calledReads" in base:
+    base = base[:base.index("_calledReads")] + "_calledReads"
+  return base + "." + call
+
+def trackNames(kind, sourceFileName):
+  if kind == "pred":
+    return [predTrackName(sourceFileName)]
+  return [readTrackName(sourceFileName, call) for call in CALLS]
+
+def buildSource(job):
+  """Writes the tracks of one source file unless they are all current.
+  Returns (kind, source, tracks, whether they were written)"""
+  kind, sourceFileName, tracksDir, force = job
+  stamp = sourceStamp(sourceFileName)
+  names = trackNames(kind, sourceFileName)
+
+  if not force and all(isCurrent(os.path.join(tracksDir, name), stamp) for name in names):
+    return kind, sourceFileName, names, False
+
+  if kind == "pred":
+    tracks, attributes = predFeatures(sourceFileName), PRED_ATTRIBUTES
+  else:
+    tracks, attributes = readFeatures(sourceFileName), READ_ATTRIBUTES
+
+  for name in names:
+    writeTrack(os.path.join(tracksDir, name), tracks.get(name, {}), attributes, stamp)
+
+  return kind, sourceFileName, names, True
+
+def findSources(predFolder, callsFolder, binSize=None):
+  """The (kind, file) of each pred and called reads file to make tracks from"""
+  sources = []
+
+  if predFolder:
+    for fileName in sorted(os.listdir(predFolder)):
+      if predIndex.isIndex(fileName) or not fileName.endswith(".txt") or ".pred" not in fileName:
+        continue
+      if binSize is not None and not fileName.endswith(".pred.{}.txt".format(binSize)):
+        continue
+      sources.append(("pred", os.path.join(predFolder, fileName)))
+
+  if callsFolder:
+    fileNames = sorted(os.listdir(callsFolder))
+    for fileName in fileNames:
+      if callStore.isStore(fileName) or not fileName.endswith(".txt"):
+        continue
+      #A strain's raw and filtered calls make the same tracks, so the filtered
+      #ones that predict used win
+      if fileName.endswith("_calledReads.txt") and fileName.replace(".txt", ".filtered.txt") in fileNames:
+        continue
+      sources.append(("read", os.path.join(callsFolder, fileName)))
+
+  return sources
+
+def writeTrackList(dataDir, predTracks, readTracks):
+  """Writes trackList.json for the tracks, the same as makeTrackList does
+  from the preds and reads directories"""
+  with open(os.path.join(dataDir, 'trackList.json'), 'w') as outFile:
+    makeTrackList.writeStart(outFile)
+    for pred in predTracks:
+      makeTrackList.writePred(pred, outFile)
+    for read in readTracks:
+      makeTrackList.writeRead(read, outFile)
+    makeTrackList.writeEnd(outFile)
+
+def makeTracks(dataDir, predFolder=None, callsFolder=None, binSize=None, jobs=1, force=False, trackList=False):
+  """Brings the tracks in dataDir up to date with the sources. Returns the
+  number of sources converted and the number skipped as current"""
+  tracksDir = os.path.join(dataDir, "tracks")
+  if not os.path.isdir(tracksDir):
+    os.makedirs(tracksDir)
+
+  jobList = [(kind, sourceFileName, tracksDir, force) for kind, sourceFileName in findSources(predFolder, callsFolder, binSize)]
+
+  if jobs > 1 and len(jobList) > 1:
+    pool = Pool(min(jobs, len(jobList)))
+    try:
+      results = pool.map(buildSource, jobList, 1)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    results = map(buildSource, jobList)
+
+  if trackList:
+    writeTrackList(dataDir,
+      [name for kind, source, names, built in results if kind == "pred" for name in names],
+      [name for kind, source, names, built in results if kind == "read" for name in names])
+
+  built = sum(1 for result in results if result[3])
+  return built, len(results) - built
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("dataDir", help="the JBrowse data folder, tracks are written to its tracks folder")
+  parser.add_argument("-p", "--preds", help="the folder of pred files")
+  parser.add_argument("-c", "--calls", help="the folder of called reads files")
+  parser.add_argument("-b", "--binSize", type=int, help="only use pred files for this bin size")
+  parser.add_argument("-j", "--jobs", type=int, default=1, help="sources to convert at once")
+  parser.add_argument("-f", "--force", action="store_true", help="rewrite tracks even if their sources haven't changed")
+  parser.add_argument("-l", "--trackList", action="store_true", help="also write trackList.json for the tracks")
+  args = parser.parse_args()
+
+  built, skipped = makeTracks(args.dataDir, args.preds, args.calls, args.binSize, args.jobs, args.force, args.trackList)
+  print "Wrote tracks for {} sources, {} were current".format(built, skipped)
@@ -4,34 +4,23 @@
 djc 4/22/14                                                                         
 '''
 
+import os
 import sys
-import csv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'main'))
+import records
 
 def convert(predsFileName, outFileName):
     	"""Convert from my pred file format to gff"""
 
     	with open(predsFileName) as reads, open(outFileName, 'w') as outFile:
-        	predsReader = csv.reader(reads, delimiter='\t')
-		writer = csv.writer(outFile, delimiter='\t')
-
-		chrome = ""
-		lastEnd = 0
-		first = True
-
-		for row in predsReader:	
-			if(first):
-				first = False
-				continue
-
-			if(row[0] != chrome):
-				lastEnd = 0
-				chrome = row[0]
-
-			out = ("CHROMOSOME_"+row[0], "Custom", "Prediction", lastEnd, row[1], ".", ".", ".", "Prediction="+row[3]+";Number of sites="+row[4]+";N2/Genotyped="+row[5]+";MY14/Genotyped="+row[6]+";Heterozygous/Genotyped="+row[7]+";Unknown/All="+row[8])
-
-			writer.writerow(out)
+		#Each region runs from the end of the breakpoint before it. Lines end
+		#in \r\n as they did from csv.writer
+		for block in records.readPreds(reads):
+			for start, end, pred, stats in zip(block.start.tolist(), block.end.tolist(), block.pred, block.stats):
+				out = ("CHROMOSOME_"+block.chrome, "Custom", "Prediction", str(start), str(end), ".", ".", ".", "Prediction="+pred+";Number of sites="+stats[0]+";N2/Genotyped="+stats[1]+";MY14/Genotyped="+stats[2]+";Heterozygous/Genotyped="+stats[3]+";Unknown/All="+stats[4])
 
-			lastEnd = row[2]
+				outFile.write('\t'.join(out) + '\r\n')
 		
 
 if __name__ == '__main__':
@@ -0,0 +1,47 @@
+import re
+
+#Read starts with their mapping quality, and the +N/-N indel markers whose
+#sequence is skipped by length below
+tokens = re.compile(r"\^.|[+-](\d+)")
+
+#Single characters that are never bases: read ends, deletion placeholders
+#and reference skips
+markers = "$*<>"
+
+def countBases(reads, nBase, mBase):
+  """Counts the reads in an mpileup bases column in one pass.
+  Returns a tuple of the number of reads with nBase, the number with mBase,
+  and the number of other (poor quality) reads.
+
+  The whole column is counted up front, then only the read start and indel
+  tokens are visited and their characters taken back out, so the cleaned
+  string is never built."""
+
+  reads = reads.upper()
+  length = len(reads)
+  n = reads.count(nBase)
+  m = reads.count(mBase)
+
+  removed = 0
+  for marker in markers:
+    removed = removed + reads.count(marker)
+
+  match = tokens.search(reads)
+  while match:
+    start = match.start()
+    end = match.end()
+
+    if match.group(1):
+      #Also skip the inserted/deleted bases themselves
+      end = min(end + int(match.group(1)), length)
+    elif reads[start + 1] in markers:
+      #A mapping quality that looks like a marker was already removed above
+      removed = removed - 1
+
+    n = n - reads.count(nBase, start, end)
+    m = m - reads.count(mBase, start, end)
+    removed = removed + end - start
+
+    match = tokens.search(reads, end)
+
+  return n, m, length - removed - n - m
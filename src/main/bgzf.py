@@ -0,0 +1,268 @@
+'''
+Reading and writing bgzip files a batch of blocks at a time, with the blocks
+of each batch inflated or deflated on a pool of threads
+
+A bgzip file is a run of gzip members of at most 64KB each, whose header says
+how long the member is. That lets the blocks be cut out of the file without
+inflating them, and handed to threads that inflate them side by side. zlib
+lets go of the GIL while it works, so the threads really do run at once.
+'''
+
+import os
+import zlib
+import struct
+import itertools
+from collections import deque
+from cStringIO import StringIO
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+#Threads per file, CONVERSION_THREADS or one per CPU
+THREADS = int(os.environ.get("CONVERSION_THREADS", 0)) or cpu_count()
+
+#Blocks handed to the pool at once, and how many such batches are kept in
+#flight ahead of the reader
+BATCH_SIZE = 64
+BATCHES_AHEAD = 2
+
+#Most uncompressed bytes in a block, as bgzip uses, so even data deflate
+#can't shrink fits in the 64KB limit
+BLOCK_DATA = 0xff00
+
+#A place in a bgzip file is given as a virtual offset, the file offset of a
+#block shifted up by VIRTUAL_SHIFT plus the offset into its data, as in the
+#indexes htslib makes
+VIRTUAL_SHIFT = 16
+VIRTUAL_MASK = (1 << VIRTUAL_SHIFT) - 1
+
+#ID1, ID2, CM, FLG, MTIME, XFL, OS, XLEN of a gzip member header
+memberHeader = struct.Struct("<BBBBIBBH")
+
+#SI1, SI2, SLEN of a subfield of the extra field
+subfieldHeader = struct.Struct("<BBH")
+
+#CRC32 and uncompressed size at the end of each member
+trailer = struct.Struct("<II")
+
+#The header of a block bgzip writes, with BSIZE, the size of the block less one
+blockHeader = struct.Struct("<BBBBIBBHBBHH")
+
+#The empty block bgzip ends a file with
+EOF_BLOCK = "1f8b08040000000000ff0600424302001b0003000000000000000000".decode("hex")
+
+def blockSize(header, extra):
+  """The total size of a block from its member header and extra field, or
+  None if the member has no BC subfield and so isn't a bgzip block"""
+  id1, id2, cm, flags = memberHeader.unpack(header)[:4]
+  if (id1, id2, cm) != (0x1f, 0x8b, 8) or not flags & 4:
+    return None
+
+  offset = 0
+  while offset + subfieldHeader.size <= len(extra):
+    si1, si2, slen = subfieldHeader.unpack_from(extra, offset)
+    if (si1, si2, slen) == (ord('B'), ord('C'), 2):
+      return struct.unpack_from("<H", extra, offset + subfieldHeader.size)[0] + 1
+    offset = offset + subfieldHeader.size + slen
+
+  return None
+
+def isBgzf(fileName):
+  """Whether a file is bgzipped rather than plain gzipped, from its first
+  block's header"""
+  with open(fileName, 'rb') as inFile:
+    header = inFile.read(memberHeader.size)
+    if len(header) < memberHeader.size:
+      return False
+
+    xlen = memberHeader.unpack(header)[7]
+    return blockSize(header, inFile.read(xlen)) is not None
+
+def inflate(block):
+  """The data of a block, given as (deflated data, crc, size)"""
+  deflated, crc, size = block
+  data = zlib.decompressobj(-15).decompress(deflated)
+
+  if len(data) != size or zlib.crc32(data) & 0xffffffff != crc:
+    raise IOError("Corrupt bgzip block")
+
+  return data
+
+def deflate(args):
+  """A whole block holding data, deflated at level"""
+  data, level = args
+  compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+  deflated = compressor.compress(data) + compressor.flush()
+
+  header = blockHeader.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, blockHeader.size + len(deflated) + trailer.size - 1)
+  return header + deflated + trailer.pack(zlib.crc32(data) & 0xffffffff, len(data))
+
+def lines(chunks):
+  """Yields the lines of text that comes in chunks cut anywhere"""
+  rest = ''
+  for data in chunks:
+    cut = data.rfind('\n') + 1
+    if not cut:
+      rest = rest + data
+      continue
+
+    for line in StringIO(rest + data[:cut]):
+      yield line
+    rest = data[cut:]
+
+  if rest:
+    yield rest
+
+def makePool(threads):
+  return ThreadPool(threads) if threads > 1 else None
+
+def runBatch(pool, func, batch):
+  """Starts func on each item of batch. Returns something whose get() gives
+  the results in order"""
+  if pool:
+    return pool.map_async(func, batch, 1)
+  return Done(map(func, batch))
+
+class Done(object):
+  """A batch run in this thread, to stand in for the pool's AsyncResult"""
+
+  def __init__(self, results):
+    self.results = results
+
+  def get(self):
+    return self.results
+
+class BgzfReader(object):
+  """Iterates over the lines of a bgzip file"""
+
+  def __init__(self, fileName, threads=THREADS):
+    self.file = open(fileName, 'rb')
+    self.pool = makePool(threads)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+    return False
+
+  def close(self):
+    self.file.close()
+    if self.pool:
+      self.pool.terminate()
+      self.pool = None
+
+  def rawBlocks(self):
+    """Yields the file offset and (deflated data, crc, size) of each block
+    from where the file is, without inflating"""
+    offset = self.file.tell()
+    while True:
+      header = self.file.read(memberHeader.size)
+      if not header:
+        return
+      if len(header) < memberHeader.size:
+        raise IOError("Truncated bgzip block")
+
+      xlen = memberHeader.unpack(header)[7]
+      extra = self.file.read(xlen)
+      size = blockSize(header, extra)
+      if size is None:
+        raise IOError("Not a bgzip block")
+
+      body = self.file.read(size - memberHeader.size - xlen)
+      if len(body) < trailer.size:
+        raise IOError("Truncated bgzip block")
+
+      crc, dataSize = trailer.unpack_from(body, len(body) - trailer.size)
+      yield offset, (body[:-trailer.size], crc, dataSize)
+      offset = offset + size
+
+  def blocks(self, start=0, end=None):
+    """Yields the virtual offset and data of each block in order from the
+    virtual offset start up to end, inflating the batches ahead of the one
+    being read on the pool. The first and last blocks are cut to start and
+    end"""
+    self.file.seek(start >> VIRTUAL_SHIFT)
+    rawBlocks = self.rawBlocks()
+    if end is not None:
+      rawBlocks = itertools.takewhile(lambda raw: raw[0] <= end >> VIRTUAL_SHIFT, rawBlocks)
+    pending = deque()
+
+    while True:
+      while len(pending) < BATCHES_AHEAD:
+        batch = list(itertools.islice(rawBlocks, BATCH_SIZE))
+        if not batch:
+          break
+        offsets, raw = zip(*batch)
+        pending.append((offsets, runBatch(self.pool, inflate, raw)))
+
+      if not pending:
+        return
+
+      offsets, result = pending.popleft()
+      for offset, data in zip(offsets, result.get()):
+        first = start & VIRTUAL_MASK if offset == start >> VIRTUAL_SHIFT else 0
+        if end is not None and offset == end >> VIRTUAL_SHIFT:
+          data = data[:end & VIRTUAL_MASK]
+        yield (offset << VIRTUAL_SHIFT) + first, data[first:]
+
+  def region(self, start=0, end=None):
+    """The lines from the virtual offset start up to end"""
+    return lines(data for offset, data in self.blocks(start, end))
+
+  def __iter__(self):
+    return self.region()
+
+  def read(self):
+    return ''.join(data for offset, data in self.blocks())
+
+class BgzfWriter(object):
+  """Writes a bgzip file, deflating batches of blocks on the pool"""
+
+  def __init__(self, fileName, level=6, threads=THREADS):
+    self.file = open(fileName, 'wb')
+    self.level = level
+    self.pool = makePool(threads)
+    self.buffer = []
+    self.buffered = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+    return False
+
+  def write(self, data):
+    self.buffer.append(data)
+    self.buffered = self.buffered + len(data)
+
+    if self.buffered >= BLOCK_DATA * BATCH_SIZE:
+      self.flush()
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def flush(self):
+    """Writes all the buffered data as blocks"""
+    data = ''.join(self.buffer)
+    self.buffer = []
+    self.buffered = 0
+
+    batch = [(data[start:start + BLOCK_DATA], self.level) for start in range(0, len(data), BLOCK_DATA)]
+    for block in runBatch(self.pool, deflate, batch).get():
+      self.file.write(block)
+
+  def close(self):
+    if self.file.closed:
+      return
+
+    try:
+      self.flush()
+      self.file.write(EOF_BLOCK)
+    finally:
+      self.file.close()
+      if self.pool:
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
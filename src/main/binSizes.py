@@ -4,17 +4,17 @@
 djc 7/11/14                                                                         
 '''
 
-import csv
+import records
 
 def binRegions(filename):
   bins = [0 for i in range(500)]
   
   with open(filename) as regionsFile:
-    reader = csv.reader(regionsFile, delimiter='\t')
-    
-    for row in reader:
-      binRegions = int(row[4].replace(",", "")) / 50
-      bins[binRegions] = bins[binRegions] + 1
+    for block in records.readPreds(regionsFile):
+      #Sizes in kbp, as the table's size column has them
+      for size in ((block.end - block.start) / 1000).tolist():
+        binRegions = size / 50
+        bins[binRegions] = bins[binRegions] + 1
       
     #Bin 419 corresponds to longest chromosome
     for i in range(419):
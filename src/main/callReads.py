@@ -4,10 +4,12 @@
 djc 3/27/14                                                                         
 '''
 
-import sys
+import os
 import csv
 import subprocess
-import re
+import tempfile
+import argparse
+import bases
 
 def callReads(mutationsFileName, bamFileName, outFileName):
     """For each position in the mutations file, run mpileup and                         
@@ -27,49 +29,108 @@ def callReads(mutationsFileName, bamFileName, outFileName):
 		#do pileup
 		pileup = subprocess.check_output(['samtools', 'mpileup', '-r', 'CHROMOSOME_%s:%s-%s' % (row[3], row[4], row[4]), bamFileName], stderr=subprocess.PIPE) 
 		
-		#parse and call
-		site = 'U'
-		n = 0
-		m = 0
-		p = 0
+		pileStr = None
 		if(len(pileup) is not 0):		
-			reads = clean(pileup.split('\t')[4].upper())
-			n = reads.count(row[5])
-			m = reads.count(row[6])
-			p = len(reads) - n - m
-
-		if(n > 0 and m > 0):
-			site = 'H'
-		elif(n > 0):
-			site = 'N'
-		elif(m > 0):
-			site = 'M'
-
-		outFile.write('\t'.join((row[3], row[4], site, str(n), str(m), str(p))) + '\n')
-
-def clean(reads):
-	"""Clean up mpileup calls so that we are left with just the bases,
-	not the extra stuff it adds"""
-
-	#Easy stuff first
-	reads = re.sub(r"[$*<>]|\^.", "", reads)
-
-	#Now do the trickier inserts/deletes
-	#First find the regex
-	while(1):
-		match = re.search(r"[+-](\d+)", reads)
-		if not match:
-			break
-
-		num = int(match.group(1))
-		#now find the index and keep the string before and after the insert/delete
-		startIndex = reads.find(match.group(0))
-		endIndex = startIndex + 1 + len(match.group(1)) + num
-		reads = reads[0:startIndex] + reads[endIndex:]		
-
-	return reads
+			pileStr = pileup.split('\t')[4]
+
+		outFile.write(callSite(row, pileStr))
+
+def callReadsBatch(mutationsFileName, bamFileName, outFileName):
+	"""Same calls as callReads, but with a single mpileup pass over the bam
+	file instead of one samtools process per site. All sites from the
+	mutations file are handed to mpileup as a positions file, and the
+	pileup stream is merge joined against the mutations file the same way
+	callReadsFromFile does. Both must be in the same (bam header) order."""
+
+	with open(mutationsFileName) as mutations:
+		positions = tempfile.NamedTemporaryFile(suffix='.pos', delete=False)
+
+		try:
+			with positions:
+				for row in csv.reader(mutations, delimiter='\t'):
+					positions.write('CHROMOSOME_%s\t%s\n' % (row[3], row[4]))
+
+			mutations.seek(0)
+
+			with open(os.devnull, 'w') as devnull, open(outFileName, 'w') as outFile:
+				samtools = subprocess.Popen(['samtools', 'mpileup', '-l', positions.name, bamFileName], stdout=subprocess.PIPE, stderr=devnull)
+				mergePileup(csv.reader(mutations, delimiter='\t'), samtools.stdout, outFile)
+				samtools.stdout.close()
+
+				if samtools.wait() != 0:
+					raise subprocess.CalledProcessError(samtools.returncode, 'samtools mpileup')
+		finally:
+			os.remove(positions.name)
+
+def mergePileup(mutReader, pileLines, outFile):
+	"""Walks the mutation rows and pileup lines together, writing a call
+	for every mutation row. Sites missing from the pileup are called U."""
+
+	pileLines = iter(pileLines)
+
+	def nextPile():
+		line = next(pileLines, None)
+		if not line:
+			return None
+		cols = line.split('\t')
+		return (cols[0].split("_")[1], int(cols[1]), cols[4])
+
+	currPile = nextPile()
+
+	#The mutations file can list the same position more than once, so hold on
+	#to the last matched pileup rather than relying on the next line
+	lastKey = None
+	lastPileStr = None
+
+	for row in mutReader:
+		key = (row[3], int(row[4]))
+
+		if key != lastKey:
+			#Skip anything in the pileup that comes before this site
+			while currPile and currPile[0] == key[0] and currPile[1] < key[1]:
+				currPile = nextPile()
+
+			lastKey = key
+			lastPileStr = None
+
+			if currPile and currPile[:2] == key:
+				lastPileStr = currPile[2]
+				currPile = nextPile()
+
+		outFile.write(callSite(row, lastPileStr))
+
+def callSite(row, pileStr):
+	"""Makes the call for one row of the mutations file from the bases column
+	of its pileup line (None if there was no pileup) and returns the output line"""
+
+	#parse and call
+	site = 'U'
+	n = 0
+	m = 0
+	p = 0
+	if pileStr is not None:
+		n, m, p = bases.countBases(pileStr, row[5], row[6])
+
+	if(n > 0 and m > 0):
+		site = 'H'
+	elif(n > 0):
+		site = 'N'
+	elif(m > 0):
+		site = 'M'
+
+	return '\t'.join((row[3], row[4], site, str(n), str(m), str(p))) + '\n'
 
 if __name__ == '__main__':
 	#print clean('*A$C>G<T+23ACACACACACACACACACAGGGGT^JC-2TTC-11AAAAAAAAAAAC+4TTTTC')
-	callReads(*sys.argv[1:])
+	parser = argparse.ArgumentParser()
+	parser.add_argument("mutationsFile", help="the table of sites to call")
+	parser.add_argument("bamFile", help="the indexed bam file of reads")
+	parser.add_argument("outputFile", help="the file to save calls to")
+	parser.add_argument("-b", "--batch", action="store_true", help="run a single mpileup pass over all sites instead of one per site")
+	args = parser.parse_args()
+
+	if args.batch:
+		callReadsBatch(args.mutationsFile, args.bamFile, args.outputFile)
+	else:
+		callReads(args.mutationsFile, args.bamFile, args.outputFile)
 	
@@ -4,15 +4,21 @@
 djc 3/27/14                                                                         
 '''
 
-import sys
-import csv
-import re
+import os
+import numpy
+import shutil
+import argparse
+import tempfile
 import util
+import bases
+import records
+import profiling
+from multiprocessing import Pool
 
 #Call het if at least one of each if True. Call het based on binomials if False
 SIMPLE_HET_CALL = True
 
-def callReads(cutoffs, mutationsFileName, pileupFileName, outFileName):
+def callReads(mutationsFileName, pileupFileName, outFileName, jobs=1):
   """For each position in the mutations file, run mpileup and                         
     parse to make a call for that position across all reads. A read                     
     can be called as N2, MY14, or pool quality. For now poor quality                    
@@ -21,53 +27,176 @@ def callReads(cutoffs, mutationsFileName, pileupFileName, outFileName):
     After calling all the reads, we make a call for the position as                     
     N2 if it only has N2 reads, MY14 if it only has MY14 reads,                         
     Heterozygous if it has at least one read of each type, or                           
-    Unknown if there are no reads or only poor quality reads."""
+    Unknown if there are no reads or only poor quality reads.
+
+    Any of the files can be gzipped or bgzipped. With more than one job,
+    each chromosome is called in its own process when both inputs can be
+    read from the middle."""
+
+  if jobs > 1 and util.isSeekable(mutationsFileName) and util.isSeekable(pileupFileName):
+    shards = findShards(mutationsFileName, pileupFileName)
+    if shards:
+      return callSharded(mutationsFileName, pileupFileName, outFileName, shards, jobs)
     
-  with open(mutationsFileName) as mutations, open(pileupFileName) as pileup, open(outFileName, 'w') as outFile:
-    mutReader = csv.reader(mutations, delimiter='\t')
-    pileReader = csv.reader(pileup, delimiter='\t')
-
-    currPileLine = next(pileReader, None)
-
-    for row in mutReader:    
-      # parse and call each site
-      site = 'U'
-      n = 0
-      m = 0
-      p = 0
-  
-      siteChrom  = row[3]
-      sitePos    = row[4]
-  
+  with util.openFile(mutationsFileName) as mutations, util.openFile(pileupFileName) as pileup, util.openFile(outFileName, 'w') as outFile, profiling.stage("callReads") as stage:
+    stage.read(mutationsFileName, pileupFileName)
+    stage.count(callSites(records.readMutations(mutations), pileSites(records.readPileup(pileup)), outFile))
+
+def pileSites(blocks):
+  """The (chrom, pos, bases) of each line of a pileup's blocks"""
+  for block in blocks:
+    for pos, reads in zip(block.pos.tolist(), block.bases):
+      yield block.chrome, pos, reads
+
+def findShards(mutationsFileName, pileupFileName):
+  """Pairs where each chromosome is in the mutations file with where it is
+  in the pileup, as (mutation range, pileup range or None) in mutations
+  file order. Returns None if either file doesn't keep its chromosomes
+  together, or if the pileup has chromosomes the mutations file lacks or
+  has them in another order, where the single merge would hold up on them"""
+  mutBlocks = util.chromeBlocks(mutationsFileName, 3)
+  pileBlocks = util.chromeBlocks(pileupFileName, 0)
+  if mutBlocks is None or pileBlocks is None:
+    return None
+
+  #Names are compared without the CHROMOSOME_ prefix, as the readers give them
+  pileRanges = dict((records.chromeName(chrome), (start, end)) for chrome, start, end in pileBlocks)
+  mutChromes = [records.chromeName(chrome) for chrome, start, end in mutBlocks]
+  if len(pileRanges) != len(pileBlocks) or len(set(mutChromes)) != len(mutChromes):
+    return None
+
+  order = [mutChromes.index(records.chromeName(chrome)) if records.chromeName(chrome) in mutChromes else -1 for chrome, start, end in pileBlocks]
+  if -1 in order or order != sorted(order):
+    return None
+
+  return [((start, end), pileRanges.get(records.chromeName(chrome))) for chrome, start, end in mutBlocks]
+
+def callShard(job):
+  """Calls one chromosome into its own file. Returns the number of sites"""
+  mutationsFileName, pileupFileName, (mutRange, pileRange), partFileName = job
+
+  with open(partFileName, 'w') as outFile:
+    mutations = records.readMutations(util.readRange(mutationsFileName, *mutRange))
+    piles = pileSites(records.readPileup(util.readRange(pileupFileName, *pileRange))) if pileRange else iter([])
+
+    return callSites(mutations, piles, outFile)
+
+def callSharded(mutationsFileName, pileupFileName, outFileName, shards, jobs):
+  """Calls the shards jobs at a time, then joins their files in order"""
+  partDir = tempfile.mkdtemp(prefix=os.path.basename(outFileName) + ".", dir=os.path.dirname(os.path.abspath(outFileName)))
+  partFileNames = [os.path.join(partDir, str(i)) for i in range(len(shards))]
+
+  try:
+    with profiling.stage("callReads") as stage:
+      stage.read(mutationsFileName, pileupFileName)
+
+      pool = Pool(min(jobs, len(shards)))
+      try:
+        counts = pool.map(callShard, [(mutationsFileName, pileupFileName, shard, partFileName) for shard, partFileName in zip(shards, partFileNames)], 1)
+      finally:
+        pool.close()
+        pool.join()
+
+      with util.openFile(outFileName, 'w') as outFile:
+        for partFileName in partFileNames:
+          with open(partFileName) as partFile:
+            shutil.copyfileobj(partFile, outFile)
+
+      stage.count(sum(counts))
+  finally:
+    shutil.rmtree(partDir)
+
+def callSites(mutations, piles, outFile):
+  """Calls the sites in each block of the mutations table against piles,
+  which yields the (chrom, pos, bases) of each pileup line in the same
+  order. Writes a line per site to outFile and returns the number of sites.
+  Reads are counted a site at a time and the sites called a block at a
+  time.
+
+  Pileup lines at positions the table lacks are passed over, as are any
+  left on a chromosome the table has moved on from, so one stray line
+  doesn't leave every later site U. Each chromosome is then called the same
+  whether it is merged on its own, as callShard does, or in the whole file"""
+
+  currPile = next(piles, None)
+  numSites = 0
+
+  #Chromosomes of the table already called, and the one being called
+  finished = set()
+  currChrome = None
+
+  for block in mutations:
+    if block.chrome != currChrome:
+      finished.add(currChrome)
+      currChrome = block.chrome
+
+    positions = block.pos.tolist()
+    ns = [0] * len(positions)
+    ms = [0] * len(positions)
+    ps = [0] * len(positions)
+
+    for i, sitePos in enumerate(positions):
+      while currPile and (currPile[0] in finished or (currPile[0] == block.chrome and currPile[1] < sitePos)):
+        currPile = next(piles, None)
+
       # If there is no pileup line, no need for checking
-      if currPileLine:
-        siteN      = row[5]
-        siteM      = row[6]
-        pileChrom  = currPileLine[0].split("_")[1]
-        pilePos    = currPileLine[1]
-        pileStr    = currPileLine[4]
-  
-        # Some sites might not appear in the pileup file.
-        # Because both files are ordered, if the current line from the pileup
-        # is not for the same location as the current site, we can just call it
-        # U with no reads and go to the next site
-        # print siteChrom
-        # print pileChrom
-        # print sitePos
-        # print pilePos
-  
-        if(siteChrom == pileChrom and sitePos == pilePos):    
-          reads = clean(pileStr.upper())
-          n = reads.count(siteN)
-          m = reads.count(siteM)
-          p = len(reads) - n - m
-          currPileLine = next(pileReader, None)
-      
-        site = call(n, m, cutoffs)
+      if not currPile:
+        break
+
+      # Some sites might not appear in the pileup file.
+      # Because both files are ordered, if the current line from the pileup
+      # is not for the same location as the current site, we can just call it
+      # U with no reads and go to the next site
+      if block.chrome == currPile[0] and sitePos == currPile[1]:
+        ns[i], ms[i], ps[i] = bases.countBases(currPile[2], block.nBase[i], block.mBase[i])
+        currPile = next(piles, None)
+
+    writeBlock(block.chrome, positions, ns, ms, ps, outFile)
+    numSites = numSites + len(positions)
 
-    outFile.write('\t'.join((siteChrom, sitePos, site, str(n), str(m), str(p))) + '\n')
+  return numSites
 
-def call(n, m, cutoffs):
+def writeBlock(chrom, positions, ns, ms, ps, outFile):
+  calls = callBatch(ns, ms).tostring()
+
+  outFile.write(''.join('\t'.join((chrom, str(pos), site, str(n), str(m), str(p))) + '\n'
+    for pos, site, n, m, p in zip(positions, calls, ns, ms, ps)))
+
+def callBatch(ns, ms):
+  """Calls a chunk of sites at once from their N2 and MY14 read counts, the
+  same way call does. Returns a numpy array of call characters as bytes.
+
+  Binomial thresholds come from the dense cutoff table in util, which grows
+  to cover the deepest site in the chunk"""
+  ns = numpy.asarray(ns, dtype=numpy.int64)
+  ms = numpy.asarray(ms, dtype=numpy.int64)
+  calls = numpy.empty(len(ns), dtype=numpy.uint8)
+  calls.fill(ord('U'))
+
+  if len(ns) == 0:
+    return calls
+
+  if SIMPLE_HET_CALL:
+    calls[ms > 0] = ord('M')
+    calls[ns > 0] = ord('N')
+    calls[(ns > 0) & (ms > 0)] = ord('H')
+  else:
+    total = ns + ms
+    table = util.getCutoffTable(int(total.max()))
+    thresholds = numpy.frombuffer(table, dtype=numpy.float64).reshape(-1, 2)[total]
+
+    #N is checked before M in call, so it is set last to win
+    called = total > 0
+    calls[called] = ord('H')
+    calls[called & (ns < thresholds[:, 0])] = ord('M')
+    calls[called & (ns > thresholds[:, 1])] = ord('N')
+
+  return calls
+
+def call(n, m, cutoffs=None):
+  """Calls a single site from its N2 and MY14 read counts. Binomial
+  thresholds come from cutoffs by number of reads, or util.cutoffs for
+  depths it does not cover"""
   call = 'U'
   
   if SIMPLE_HET_CALL:
@@ -82,7 +211,7 @@ def call(n, m, cutoffs):
   
     if(total > 0):
       # The total number of reads determine how many instances we need to make a call
-      thresholds = cutoffs[total]
+      thresholds = cutoffs[total] if cutoffs and total in cutoffs else util.cutoffs(total)
     
       if(n > thresholds[1]):
         call = 'N'
@@ -93,34 +222,14 @@ def call(n, m, cutoffs):
       
   return call
 
-def clean(reads):
-  """Clean up mpileup calls so that we are left with just the bases,
-  not the extra stuff it adds"""
-
-  # Easy stuff first
-  reads = re.sub(r"[$*<>]|\^.", "", reads)
-
-  # Now do the trickier inserts/deletes
-  # First find the regex
-  while(1):
-    match = re.search(r"[+-](\d+)", reads)
-    if not match:
-      break
-
-    num = int(match.group(1))
-    # now find the index and keep the string before and after the insert/delete
-    startIndex = reads.find(match.group(0))
-    endIndex = startIndex + 1 + len(match.group(1)) + num
-    reads = reads[0:startIndex] + reads[endIndex:]    
-
-  return reads
-
 if __name__ == '__main__':
   # print clean('*A$C>G<T+23ACACACACACACACACACAGGGGT^JC-2TTC-11AAAAAAAAAAAC+4TTTTC')
-  hetCutoffs = {}
-  
-  for i in range(1, 500):
-    hetCutoffs[i] = util.cutoffs(i)
-    
-  callReads(hetCutoffs, *sys.argv[1:])
+  parser = argparse.ArgumentParser()
+  parser.add_argument("mutationsFile", help="the mutations table")
+  parser.add_argument("pileupFile", help="the mpileup, can be .gz/.bgz")
+  parser.add_argument("outputFile", help="the file to save calls to, compressed if it ends in .gz/.bgz")
+  parser.add_argument("-j", "--jobs", type=int, default=1, help="chromosomes to call at once")
+  args = parser.parse_args()
+
+  profiling.run("callReadsFromFile", callReads, args.mutationsFile, args.pileupFile, args.outputFile, args.jobs)
   
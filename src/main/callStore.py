@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+'''
+Binary, memory-mappable store for called reads files
+'''
+
+import os
+import sys
+import mmap
+import struct
+import numpy
+from array import array
+from collections import OrderedDict
+
+import records
+import siteStore
+
+#The store sits next to the text file it was made from, as <text file>.bin
+SUFFIX = ".bin"
+
+MAGIC = "CALLSTOR"
+VERSION = 1
+
+#magic, version, number of chromosomes, number of sites, then the byte offset
+#of each column in COLUMNS order
+header = struct.Struct("<8sIIQ5Q")
+
+#Longest chromosome name the store can hold
+NAME_SIZE = 32
+
+#name, index of the chromosome's first site, number of sites
+chromeEntry = struct.Struct("<{}sQQ".format(NAME_SIZE))
+
+#Each column holds every site, chromosome by chromosome in file order
+COLUMNS = (("pos", numpy.int32), ("n", numpy.int32), ("m", numpy.int32), ("p", numpy.int32), ("call", numpy.uint8))
+
+def storePath(textFileName):
+  return textFileName + SUFFIX
+
+def isStore(fileName):
+  return fileName.endswith(SUFFIX)
+
+def openCalls(textFileName):
+  """Returns a CallStore for the called reads file if it has one that is at
+  least as new as the text, or None if it should be read as text"""
+  path = storePath(textFileName)
+
+  if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(textFileName):
+    return CallStore(path)
+
+  return None
+
+def convert(textFileName, storeFileName=None):
+  """Writes the store for a called reads file of chrom, pos, call, n, m, p
+  lines, keeping the file order. The file must keep each chromosome's lines
+  together, as the store can't give the sites back in any other order"""
+  if storeFileName is None:
+    storeFileName = storePath(textFileName)
+
+  chromes = OrderedDict()
+
+  with open(textFileName) as textFile:
+    for block in records.readCalls(textFile):
+      if block.chrome not in chromes:
+        if len(block.chrome) > NAME_SIZE:
+          raise ValueError("Chromosome name {} is longer than {} characters".format(block.chrome, NAME_SIZE))
+        chromes[block.chrome] = (array('i'), array('i'), array('i'), array('i'), bytearray())
+      elif block.chrome != next(reversed(chromes)):
+        raise ValueError("{} is not grouped by chromosome, {} comes up again after {}".format(textFileName, block.chrome, next(reversed(chromes))))
+      columns = chromes[block.chrome]
+
+      for column, values in zip(columns[:4], (block.pos, block.n, block.m, block.p)):
+        column.fromstring(values.tostring())
+      columns[4].extend(block.call.tostring())
+
+  numSites = sum(len(columns[0]) for columns in chromes.values())
+
+  #Columns start after the header and chromosome table, each 8 byte aligned
+  offsets = []
+  offset = header.size + chromeEntry.size * len(chromes)
+  for name, dtype in COLUMNS:
+    offset = (offset + 7) & ~7
+    offsets.append(offset)
+    offset = offset + numSites * numpy.dtype(dtype).itemsize
+
+  with open(storeFileName + ".tmp", 'wb') as storeFile:
+    storeFile.write(header.pack(MAGIC, VERSION, len(chromes), numSites, *offsets))
+
+    start = 0
+    for chrome, columns in chromes.items():
+      storeFile.write(chromeEntry.pack(chrome, start, len(columns[0])))
+      start = start + len(columns[0])
+
+    for i, offset in enumerate(offsets):
+      storeFile.write('\0' * (offset - storeFile.tell()))
+      for columns in chromes.values():
+        storeFile.write(columns[i].tostring() if i < 4 else str(columns[i]))
+
+  os.rename(storeFileName + ".tmp", storeFileName)
+
+class CallStore(object):
+  """A called reads store mapped into memory. Columns are numpy views
+  straight onto the mapped file, so loading one copies nothing"""
+
+  def __init__(self, fileName):
+    with open(fileName, 'rb') as storeFile:
+      self.map = mmap.mmap(storeFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    fields = header.unpack_from(self.map, 0)
+    if fields[0] != MAGIC or fields[1] != VERSION:
+      raise ValueError("{} is not a version {} called reads store".format(fileName, VERSION))
+
+    numChromes = fields[2]
+    self.numSites = fields[3]
+    self.offsets = dict(zip([name for name, dtype in COLUMNS], fields[4:]))
+
+    #Chromosome name to (first site, number of sites), in file order
+    self.chromes = OrderedDict()
+    for i in range(numChromes):
+      name, start, count = chromeEntry.unpack_from(self.map, header.size + i * chromeEntry.size)
+      self.chromes[name.rstrip('\0')] = (start, count)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    self.map.close()
+
+  def column(self, name, chrome=None):
+    """A view of the named column, for the whole file or one chromosome"""
+    dtype = dict(COLUMNS)[name]
+    start, count = self.chromes[chrome] if chrome else (0, self.numSites)
+
+    return numpy.frombuffer(self.map, dtype=dtype, count=count, offset=self.offsets[name] + start * numpy.dtype(dtype).itemsize)
+
+  def blocks(self):
+    """Yields each chromosome as a records.Calls block, the same as reading
+    the text file would give"""
+    for chrome in self.chromes:
+      yield records.Calls(chrome, *[self.column(name, chrome) for name in ("pos", "call", "n", "m", "p")])
+
+  def sites(self, chrome):
+    """The calls and positions of one chromosome as a siteStore.Sites"""
+    calls = bytearray(self.column("call", chrome).tostring())
+    positions = array('i', self.column("pos", chrome).tostring())
+
+    return siteStore.Sites(columns=(calls, positions, None))
+
+  def genotypedSites(self):
+    """Yields (chrome, sites) for each chromosome in file order, where sites
+    is a siteStore.Sites of the sites that are not U, with the number of U
+    sites skipped before each one the way predict counts them (carrying over
+    from the end of the previous chromosome). Chromosomes with no genotyped
+    sites are left out"""
+    lastGenotyped = -1
+
+    for chrome, (start, count) in self.chromes.items():
+      calls = self.column("call", chrome)
+      genotyped = numpy.flatnonzero(calls != ord('U'))
+      if len(genotyped) == 0:
+        continue
+
+      uCounts = numpy.diff(numpy.concatenate(([lastGenotyped - start], genotyped))) - 1
+      lastGenotyped = start + genotyped[-1]
+
+      columns = (bytearray(calls[genotyped].tostring()),
+                 array('i', self.column("pos", chrome)[genotyped].tostring()),
+                 array('i', uCounts.astype(numpy.int32).tostring()))
+      yield chrome, siteStore.Sites(columns=columns)
+
+if __name__ == '__main__':
+  for textFileName in sys.argv[1:]:
+    convert(textFileName)
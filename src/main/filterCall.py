@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+
+'''
+Filters a raw pileup and calls the mutation sites from it in one pass, the
+same as filterPileup then callReadsFromFile without the filtered pileup
+'''
+
+import argparse
+
+import util
+import records
+import profiling
+import filterPileup
+import callReadsFromFile
+
+def filterCall(mutationsFileName, pileupFileName, filterFileName, outFileName):
+  """Streams the pileup through the filter straight into the caller.
+  Any of the files can be gzipped or bgzipped"""
+
+  with util.openFile(mutationsFileName) as mutations, util.openFile(pileupFileName) as pileup, util.openFile(outFileName, 'w') as outFile, profiling.stage("filterCall") as stage:
+    stage.read(mutationsFileName, pileupFileName, filterFileName)
+    piles = (bases(chrom, pos, line) for chrom, pos, line in filterPileup.filterLines(pileup, filterFileName))
+    stage.count(callReadsFromFile.callSites(records.readMutations(mutations), piles, outFile))
+
+def bases(chrom, pos, line):
+  """The (chrom, pos, bases) the caller takes from a filtered pileup line"""
+  return chrom, pos, line.split('\t', 5)[4]
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("mutationsFile", help="the mutations table")
+  parser.add_argument("pileupFile", help="the raw mpileup, can be .gz/.bgz")
+  parser.add_argument("filterFile", help="the positions to keep from the pileup")
+  parser.add_argument("outputFile", help="the file to save calls to, gzipped if it ends in .gz/.bgz")
+  args = parser.parse_args()
+
+  profiling.run("filterCall", filterCall, args.mutationsFile, args.pileupFile, args.filterFile, args.outputFile)
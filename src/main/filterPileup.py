@@ -5,27 +5,123 @@ djc 4/7/14
 '''
 
 import sys
-import csv
+import bisect
+import itertools
+import util
+import records
+import profiling
+from array import array
+from collections import defaultdict
 
 def filterReads(pileFileName, filterFileName, outFileName):
-    	"""Only keeps rows from the given pileup file which have a position
-	found in filter"""
+	"""Only keeps rows from the given pileup file which have a position
+	found in filter. Either file, and the output, can be gzipped"""
 
-    	with open(pileFileName) as piles, open(filterFileName) as filterFile, open(outFileName, 'w') as outFile:
-        	pileReader = csv.reader(piles, delimiter='\t')
-		filterReader = csv.reader(filterFile, delimiter='\t')
-		writer = csv.writer(outFile, delimiter='\t')
+	with util.openFile(pileFileName) as piles, util.openFile(outFileName, 'w') as outFile, profiling.stage("filterPileup") as stage:
+		stage.read(pileFileName, filterFileName)
 
-		good = {(loc[0], loc[1]) for loc in filterReader}
+		for chrom, pos, line in filterLines(stage.lines(piles), filterFileName):
+			outFile.write(line)
 
-		for row in pileReader:	
-			chrom = row[0].split("_")[1]
+def filterLines(piles, filterFileName):
+	"""Yields the (chrom, pos, line) of each line of piles which has a
+	position found in filter, with the line rewritten with the CHROMOSOME_
+	prefix dropped.
 
-			if( (chrom, row[1]) in good ):
-				row[0] = chrom
-				writer.writerow(row)
-		
+	Both files are normally sorted by chromosome then position, so they are
+	merge joined in constant memory. Pileup chromosomes the filter does not
+	have are skipped. If either turns out not to be sorted, the filter
+	positions are indexed instead for the rest of the pileup. The lines
+	already merged are the same ones the index would have kept, since
+	the merge is right for as long as the pileup is in order"""
+
+	pileLines = readPileup(piles)
+	chromeOrder = scanFilter(filterFileName)
+
+	if chromeOrder is not None:
+		with util.openFile(filterFileName) as filterFile:
+			filterLocs = ((chromeOrder[chrom], pos) for chrom, pos in readFilter(filterFile))
+			currFilter = next(filterLocs, None)
+			lastPile = (-1, 0)
+
+			for chrom, pos, line in pileLines:
+				rank = chromeOrder.get(chrom)
+				if rank is None:
+					continue
+
+				pile = (rank, pos)
+				if pile < lastPile:
+					#Look this line and the rest up in the index
+					pileLines = itertools.chain([(chrom, pos, line)], pileLines)
+					break
+				lastPile = pile
+
+				while currFilter and currFilter < pile:
+					currFilter = next(filterLocs, None)
+
+				if currFilter == pile:
+					yield chrom, pos, line
+			else:
+				return
+
+	for pile in indexLines(pileLines, filterFileName):
+		yield pile
+
+def readFilter(filterFile):
+	"""Yields the (chrom, pos) of each line of the filter file"""
+	for block in records.readPositions(filterFile):
+		for pos in block.pos.tolist():
+			yield block.chrome, pos
+
+def readPileup(piles):
+	"""Yields the chrom and pos of each pileup line along with the line
+	rewritten with the CHROMOSOME_ prefix dropped"""
+	for line in piles:
+		chromField, pos, rest = line.split('\t', 2)
+		chrom = records.chromeName(chromField)
+		yield chrom, int(pos), chrom + '\t' + pos + '\t' + rest
+
+def scanFilter(filterFileName):
+	"""Maps each chromosome in the filter file to its place in the file's
+	chromosome order. Returns None if the file is not sorted, that is if a
+	chromosome shows up in more than one block or positions go backwards"""
+	chromeOrder = {}
+	lastChrom = None
+	lastPos = 0
+
+	with util.openFile(filterFileName) as filterFile:
+		for chrom, pos in readFilter(filterFile):
+			if chrom != lastChrom:
+				if chrom in chromeOrder:
+					return None
+				chromeOrder[chrom] = len(chromeOrder)
+				lastChrom = chrom
+			elif pos < lastPos:
+				return None
+
+			lastPos = pos
+
+	return chromeOrder
+
+def indexLines(pileLines, filterFileName):
+	"""Keeps the filter positions as a sorted int array per chromosome and
+	looks up each pileup line by binary search"""
+
+	with util.openFile(filterFileName) as filterFile:
+		good = defaultdict(lambda: array('i'))
+		for chrom, pos in readFilter(filterFile):
+			good[chrom].append(pos)
+
+	for chrom in good:
+		good[chrom] = array('i', sorted(good[chrom]))
+
+	for chrom, pos, line in pileLines:
+		positions = good.get(chrom)
+		if positions:
+			i = bisect.bisect_left(positions, pos)
+			if i < len(positions) and positions[i] == pos:
+				yield chrom, pos, line
 
 if __name__ == '__main__':
-	filterReads(*sys.argv[1:])
+	profiling.run("filterPileup", filterReads, *sys.argv[1:])
 	
@@ -5,29 +5,135 @@ djc 4/7/14
 '''
 
 import sys
-import csv
+import numpy
+
+import records
+import callStore
+import profiling
 
 def filterReads(readsFileName, filterFileName, outFileName):
     	"""Only keeps rows from the given file of reads which have a position
 	found in filter"""
 
-    	with open(readsFileName) as reads, open(filterFileName) as filterFile, open(outFileName, 'w') as outFile:
-        	readsReader = csv.reader(reads, delimiter='\t')
-		filterReader = csv.reader(filterFile, delimiter='\t')
-		writer = csv.writer(outFile, delimiter='\t')
+    	with open(readsFileName) as reads, open(filterFileName) as filterFile, open(outFileName, 'w') as outFile, profiling.stage("filterReads") as stage:
+		stage.read(readsFileName, filterFileName)
+		filterRuns = readFilter(filterFile)
+
+		#Use the binary store of the reads if there is one
+		store = callStore.openCalls(readsFileName)
+		if store:
+			with store:
+				rows = filterBlocks(((block, None) for block in store.blocks()), filterRuns, outFile)
+		else:
+			#Text rows are written back as they are, so only their chrome and
+			#pos are parsed
+			rows = filterBlocks(records.readPositions(reads, True), filterRuns, outFile)
+
+		stage.count(rows)
+
+def filterBlocks(blocks, filterRuns, outFile):
+	"""Writes the rows of each (block, the block's lines or None) that are in
+	filterRuns, the lines as they are or, without them, the block's columns.
+	Returns the number of rows read"""
+
+	#The filter run and the offset into it of the next position to find
+	place = [0, 0]
+	rows = 0
+
+	for block, rowLines in blocks:
+		#If we hit the end of the filter file we are done
+		if place[0] == len(filterRuns):
+			break;
+
+		kept = matchRows(block.chrome, block.pos, filterRuns, place)
+		rows = rows + len(block.pos)
+
+		if rowLines is None:
+			writeRows(block, kept, outFile)
+		else:
+			writeLines([rowLines[i] for i in kept.tolist()], outFile)
+
+	return rows
+
+def readFilter(filterFile):
+	"""The filter file as a list of (chrome, positions, inOrder) for each
+	run of lines on one chromosome, inOrder being whether the positions
+	only go up"""
+	runs = []
+	for block in records.readPositions(filterFile):
+		if runs and runs[-1][0] == block.chrome:
+			runs[-1][1].append(block.pos)
+		else:
+			runs.append((block.chrome, [block.pos]))
+
+	filterRuns = []
+	for chrome, blocks in runs:
+		positions = numpy.concatenate(blocks)
+		filterRuns.append((chrome, positions, bool((numpy.diff(positions) > 0).all())))
+
+	return filterRuns
+
+def matchRows(chrome, positions, filterRuns, place):
+	"""The indexes of the rows of a block with the filter's next positions,
+	moving place on past them. The filter is walked through in order, so a
+	filter position missing from the reads holds up the rest of the filter
+	the same as the line by line merge. When both are in order that is a
+	sorted search over the part of the filter up to the block's last
+	position, otherwise the rows are merged one at a time"""
+	kept = []
+	inOrder = (numpy.diff(positions) > 0).all()
+
+	while place[0] < len(filterRuns) and filterRuns[place[0]][0] == chrome:
+		filterChrome, filterPositions, filterInOrder = filterRuns[place[0]]
+		if not inOrder or not filterInOrder:
+			return numpy.array(kept + mergeRows(chrome, positions, filterRuns, place), dtype=numpy.int64)
+
+		rest = filterPositions[place[1]:]
+		ahead = rest[:numpy.searchsorted(rest, positions[-1], 'right')]
+
+		#Each filter position is found in turn up to the first one that isn't
+		found = numpy.searchsorted(positions, ahead)
+		matched = positions[found] == ahead
+		numFound = len(matched) if matched.all() else matched.argmin()
+
+		kept.extend(found[:numFound].tolist())
+		if numFound < len(rest):
+			place[1] = place[1] + numFound
+			break
+
+		place[0] = place[0] + 1
+		place[1] = 0
+
+	return numpy.array(kept, dtype=numpy.int64)
+
+def mergeRows(chrome, positions, filterRuns, place):
+	"""matchRows a row at a time"""
+	kept = []
+
+	for i, pos in enumerate(positions.tolist()):
+		if place[0] == len(filterRuns):
+			break;
+
+		filterChrome, filterPositions, filterInOrder = filterRuns[place[0]]
+		if( (chrome == filterChrome) and (pos == filterPositions[place[1]]) ):
+			kept.append(i)
+			place[1] = place[1] + 1
+			if place[1] == len(filterPositions):
+				place[0] = place[0] + 1
+				place[1] = 0
+
+	return kept
 
-		filterLine = next(filterReader, None)
+def writeLines(lines, outFile):
+	"""Writes lines ending in CRLF, as csv.writer did"""
+	outFile.write(''.join(lines).replace('\r\n', '\n').replace('\n', '\r\n'))
 
-		for row in readsReader:	
-			#If we hit the end of the filter file we are done
-			if not filterLine:
-				break;
+def writeRows(block, kept, outFile):
+	"""Writes the lines of the block's rows at the indexes in kept"""
+	columns = [block.pos[kept].tolist(), block.call[kept].tostring(), block.n[kept].tolist(), block.m[kept].tolist(), block.p[kept].tolist()]
 
-			if( (row[0] == filterLine[0]) and (row[1] == filterLine[1]) ):
-				writer.writerow(row)
-				filterLine = next(filterReader, None)
-		
+	writeLines(['\t'.join((block.chrome, str(pos), call, str(n), str(m), str(p))) + '\n' for pos, call, n, m, p in zip(*columns)], outFile)
 
 if __name__ == '__main__':
-	filterReads(*sys.argv[1:])
+	profiling.run("filterReads", filterReads, *sys.argv[1:])
 	
@@ -5,79 +5,188 @@ djc 4/7/14
 '''
 
 import os
-import sys
 import csv
-from collections import OrderedDict
+import argparse
+import numpy
+from array import array
+from collections import defaultdict
+from multiprocessing import Pool
 
-def findFixed(sitesFileName, readsDir):
+import callStore
+import records
+import profiling
+
+#Candidate site index shared with the worker processes, set by setSites
+siteIndex = None
+
+def findFixed(sitesFileName, readsDir, jobs=1):
 	"""For each position in the sites file, check whether it is
 	found to have been called as both MY14 and N2 within some
 	set of reads in the reads directory. If so, save it to notFixed.txt,
-	else save to fixed.txt"""
-
-	#For each site, keep track of whether we have seen a read for both MY14 and N2
-	candSites = OrderedDict()
-	notFixed = []
-
-    	with open(sitesFileName) as sites:
-        	siteReader = csv.reader(sites, delimiter='\t')
-
-		for line in siteReader:
-			#tuple of chrome, pos as key for dict, then whether we have seen M
-			#and N respectively
-			#Use ints for position so sorting works properly for notFixed
-			candSites[(line[0].split("_")[1], int(line[1]))] = (False, False)
-
-		#With that dictionary, now check the sites in each file
-		for fileName in os.listdir(readsDir):
-			print fileName
-			with open(os.path.join(readsDir, fileName)) as currFile:
-				reader = csv.reader(currFile, delimiter='\t')
-
-				for line in reader:
-					key = (line[0], int(line[1]))
-
-					#If we have removed this site from consideration, 
-					#keep going
-					if not key in candSites:
-						continue
-
-					call = line[2]					
-					check = True
-
-					if(call == 'M'):
-						candSites[key] = (True, candSites[key][1])
-					elif(call == 'N'):
-						candSites[key] = (candSites[key][0], True)
-					elif(call == 'H'):
-						candSites[key] = (True, True)
-					else:
-						check = False
-
-					#If that site has seen both now, move it to notFixed
-					if check and candSites[key][0] and candSites[key][1]:
-						del candSites[key]
-						notFixed.append(key)
-
-						#If we found both for every site, quit looking
-						if(len(candSites) == 0):
-							break
-
-		print "Fixed: " + str(len(candSites))
-		print "Not Fixed: " + str(len(notFixed))
-
-	with open('fixed.txt', 'w') as fixedFile, open('notFixed.txt', 'w') as notFixedFile:
+	else save to fixed.txt
+
+	Each distinct site gets an integer index, and whether it has been seen
+	as M and as N is kept in two boolean arrays. Each reads file is matched
+	against the sites a chromosome at a time with a sorted search, and the
+	files are read jobs at a time in parallel"""
+
+	with profiling.stage("loadSites") as stage:
+		stage.read(sitesFileName)
+		sites, index = loadSites(sitesFileName)
+		stage.count(len(sites))
+
+	seenM = numpy.zeros(len(sites), dtype=bool)
+	seenN = numpy.zeros(len(sites), dtype=bool)
+
+	#Binary stores are read in place of the text file they were made from
+	fileNames = [os.path.join(readsDir, fileName) for fileName in sorted(os.listdir(readsDir)) if not callStore.isStore(fileName)]
+
+	if jobs > 1:
+		pool = Pool(jobs, setSites, (index,))
+		results = pool.imap(foldFile, fileNames)
+	else:
+		pool = None
+		setSites(index)
+		results = (foldFile(fileName) for fileName in fileNames)
+
+	try:
+		with profiling.stage("foldFiles") as stage:
+			stage.read(*fileNames)
+			stage.count(len(fileNames))
+
+			for fileName, fileM, fileN in results:
+				print os.path.basename(fileName)
+				seenM |= numpy.unpackbits(fileM)[:len(sites)].astype(bool)
+				seenN |= numpy.unpackbits(fileN)[:len(sites)].astype(bool)
+	finally:
+		if pool:
+			pool.close()
+			pool.join()
+
+	both = seenM & seenN
+
+	#Fixed sites stay in sites file order, not fixed are sorted by position
+	fixed = [sites[i] for i in numpy.flatnonzero(~both)]
+	notFixed = sorted(sites[i] for i in numpy.flatnonzero(both))
+
+	print "Fixed: " + str(len(fixed))
+	print "Not Fixed: " + str(len(notFixed))
+
+	with open('fixed.txt', 'w') as fixedFile, open('notFixed.txt', 'w') as notFixedFile, profiling.stage("writeSites") as stage:
+		stage.count(len(sites))
 		fixedWriter = csv.writer(fixedFile, delimiter='\t')
-		for site in candSites.keys():
+		for site in fixed:
 			fixedWriter.writerow(site)
 
-		#Sort by position first
-		notFixed.sort()
 		notFixedWriter = csv.writer(notFixedFile, delimiter='\t')	
 		for site in notFixed:
 			notFixedWriter.writerow(site)
 
+def loadSites(sitesFileName):
+	"""Gives each distinct (chrome, pos) in the sites file an index, in the
+	order they first appear. Returns the list of sites by index, and a map
+	of chromosome to its sorted positions and the index of each"""
+
+	chromeLines = defaultdict(lambda: (array('i'), array('i')))
+
+	with open(sitesFileName) as sitesFile:
+		lineNum = 0
+		for block in records.readPositions(sitesFile):
+			#Use ints for position so sorting works properly for notFixed
+			positions, lineNums = chromeLines[block.chrome]
+			positions.fromstring(block.pos.tostring())
+			lineNums.extend(xrange(lineNum, lineNum + len(block.pos)))
+			lineNum = lineNum + len(block.pos)
+
+	#Keep the first line each position is on
+	chromes = []
+	firstLines = []
+	for chrome, (positions, lineNums) in chromeLines.items():
+		positions, first = numpy.unique(numpy.frombuffer(positions, dtype=numpy.int32), return_index=True)
+		chromes.append((chrome, positions))
+		firstLines.append(numpy.frombuffer(lineNums, dtype=numpy.int32)[first])
+
+	#Number the sites by first line
+	firstLines = numpy.concatenate(firstLines) if firstLines else numpy.zeros(0, dtype=numpy.int32)
+	order = numpy.argsort(firstLines, kind='mergesort')
+	siteNums = numpy.empty(len(order), dtype=numpy.int64)
+	siteNums[order] = numpy.arange(len(order))
+
+	sites = [None] * len(order)
+	index = {}
+	start = 0
+	for chrome, positions in chromes:
+		indexes = siteNums[start:start + len(positions)]
+		index[chrome] = (positions, indexes)
+		for pos, i in zip(positions.tolist(), indexes.tolist()):
+			sites[i] = (chrome, pos)
+		start = start + len(positions)
+
+	return sites, index
+
+def setSites(index):
+	global siteIndex
+	siteIndex = index
+
+def foldFile(fileName):
+	"""Finds which candidate sites this reads file calls as M and as N
+	(H counts as both). Returns the file name with the two sets of flags
+	packed into bits"""
+	numSites = sum(len(positions) for positions, indexes in siteIndex.values())
+	seenM = numpy.zeros(numSites, dtype=bool)
+	seenN = numpy.zeros(numSites, dtype=bool)
+
+	#Use the binary store of the calls if there is one. Its columns are views
+	#onto the mapped file, which stays open until they are dropped
+	store = callStore.openCalls(fileName)
+	if store:
+		chromes = dict((chrome, (store.column("pos", chrome), store.column("call", chrome))) for chrome in store.chromes)
+	else:
+		chromes = readCalls(fileName)
+
+	for chrome, (positions, calls) in chromes.items():
+		if chrome not in siteIndex:
+			continue
+
+		sitePositions, siteIndexes = siteIndex[chrome]
+		positions = numpy.frombuffer(positions, dtype=numpy.int32)
+		calls = numpy.frombuffer(calls, dtype=numpy.uint8)
+
+		#Keep only the reads at candidate sites
+		found = numpy.searchsorted(sitePositions, positions)
+		found[found == len(sitePositions)] = 0
+		match = sitePositions[found] == positions
+		indexes = siteIndexes[found[match]]
+		calls = calls[match]
+
+		het = calls == ord('H')
+		seenM[indexes[het | (calls == ord('M'))]] = True
+		seenN[indexes[het | (calls == ord('N'))]] = True
+
+	return fileName, numpy.packbits(seenM), numpy.packbits(seenN)
+
+def readCalls(fileName):
+	"""Reads the chrome, position and call of each line of a reads file,
+	as a map of chromosome to a position array and a bytearray of calls.
+	Calls other than a single M, N or H are stored as U"""
+
+	chromes = defaultdict(lambda: (array('i'), bytearray()))
+
+	with open(fileName) as currFile:
+		for block in records.readCalls(currFile):
+			genotyped = (block.call == ord('M')) | (block.call == ord('N')) | (block.call == ord('H'))
+			positions, calls = chromes[block.chrome]
+			positions.fromstring(block.pos.tostring())
+			calls.extend(numpy.where(genotyped, block.call, ord('U')).astype(numpy.uint8).tostring())
+
+	return chromes
+
 if __name__ == '__main__':
-	#print clean('*A$C>G<T+23ACACACACACACACACACAGGGGT^JC-2TTC-11AAAAAAAAAAAC+4TTTTC')
-	findFixed(*sys.argv[1:])
+	parser = argparse.ArgumentParser()
+	parser.add_argument("sitesFile", help="the file of candidate sites")
+	parser.add_argument("readsDir", help="the directory of called reads files")
+	parser.add_argument("-j", "--jobs", type=int, default=1, help="number of reads files to read at once")
+	args = parser.parse_args()
+
+	profiling.run("fixedSites", findFixed, args.sitesFile, args.readsDir, args.jobs)
 	
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+
+'''
+Runs the per strain pipeline, filterPileup, callReadsFromFile, filterReads,
+predict and predToGff, then makeTracks for the cohort's JBrowse tracks and
+track list, redoing only the stages whose inputs or settings changed
+
+Each stage is keyed by a hash of its input files' contents, its settings and
+the source of the modules that run it and every pipeline module they import.
+A stage whose key matches the one it last ran with, and whose outputs are
+still as it left them, is skipped. Each strain keeps its own build state, so
+strains run at the same time in a pool of workers and a change to one strain
+only reruns that strain's stages.
+'''
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import traceback
+import types
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'display'))
+import profiling
+import filterPileup
+import callReadsFromFile
+import filterReads
+import predict
+import predToGff
+import makeTracks
+
+#Where the build state of each strain and of the cohort is kept in outDir
+STATE_DIR = ".build"
+
+HASH_BLOCK = 1 << 20
+
+#Modules under here are part of the pipeline and key the stages that use them
+SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def fileHash(fileName, known):
+  """The sha1 of a file's contents. known maps file names to the (mtime,
+  size, hash) they were last hashed at, so unchanged files aren't reread"""
+  info = os.stat(fileName)
+  seen = known.get(fileName)
+  if seen and seen[0] == info.st_mtime and seen[1] == info.st_size:
+    return seen[2]
+
+  digest = hashlib.sha1()
+  with open(fileName, 'rb') as inFile:
+    for block in iter(lambda: inFile.read(HASH_BLOCK), ''):
+      digest.update(block)
+
+  known[fileName] = (info.st_mtime, info.st_size, digest.hexdigest())
+  return digest.hexdigest()
+
+def moduleFile(module):
+  """The source of a module, not its .pyc"""
+  fileName = module.__file__
+  return fileName[:-1] if fileName.endswith(".pyc") else fileName
+
+def moduleClosure(modules):
+  """The modules along with every pipeline module they import, directly or
+  through others, sorted by file"""
+  found = {}
+  pending = list(modules)
+
+  while pending:
+    module = pending.pop()
+    fileName = moduleFile(module)
+    if fileName in found:
+      continue
+
+    found[fileName] = module
+    for value in vars(module).values():
+      if isinstance(value, types.ModuleType) and getattr(value, "__file__", None) and os.path.abspath(value.__file__).startswith(SOURCE_DIR + os.sep):
+        pending.append(value)
+
+  return [found[fileName] for fileName in sorted(found)]
+
+def stageKey(name, inputs, settings, modules, known):
+  """The hash a stage's outputs are keyed by, which covers the source of
+  every pipeline module the stage's own modules import"""
+  digest = hashlib.sha1(name)
+  for fileName in inputs:
+    digest.update(fileHash(fileName, known))
+  for module in moduleClosure(modules):
+    digest.update(fileHash(moduleFile(module), known))
+  digest.update(json.dumps(settings, sort_keys=True))
+  return digest.hexdigest()
+
+def outputStamp(fileName):
+  info = os.stat(fileName)
+  return [info.st_mtime, info.st_size]
+
+class Build(object):
+  """The stages run for one strain or the cohort, with the keys and output
+  stamps each ran with, saved as JSON in the state directory"""
+
+  def __init__(self, stateFileName):
+    self.stateFileName = stateFileName
+    self.stages = {}
+    self.known = {}
+
+    if os.path.exists(stateFileName):
+      with open(stateFileName) as stateFile:
+        state = json.load(stateFile)
+      self.stages = state["stages"]
+      self.known = dict((fileName, tuple(seen)) for fileName, seen in state["hashes"].items())
+
+  def save(self):
+    with open(self.stateFileName + ".tmp", 'w') as stateFile:
+      json.dump({"stages": self.stages, "hashes": self.known}, stateFile, indent=2, sort_keys=True)
+    os.rename(self.stateFileName + ".tmp", self.stateFileName)
+
+  def isCurrent(self, name, key, outputs):
+    last = self.stages.get(name)
+    if not last or last["key"] != key:
+      return False
+
+    return all(os.path.exists(fileName) and outputStamp(fileName) == last["outputs"].get(fileName) for fileName in outputs)
+
+  def run(self, name, inputs, outputs, settings, modules, func, *args):
+    """Runs func(*args) unless the stage is current. Returns whether it ran"""
+    key = stageKey(name, inputs, settings, modules, self.known)
+    if self.isCurrent(name, key, outputs):
+      return False
+
+    func(*args)
+
+    self.stages[name] = {"key": key, "outputs": dict((fileName, outputStamp(fileName)) for fileName in outputs)}
+    self.save()
+    return True
+
+def predictSettings(binSize, deleteHet, extendEnds, tablePrint):
+  return {"binSize": binSize, "DELETE_HET": deleteHet, "EXTEND_ENDS": extendEnds, "TABLE_PRINT": tablePrint}
+
+def strainFiles(outDir, strain, binSize):
+  """The files a strain's stages write, by stage"""
+  return {
+    "filterPileup": os.path.join(outDir, "piles", strain + ".pileup.filtered.txt"),
+    "callReadsFromFile": os.path.join(outDir, "calls", strain + "_calledReads.txt"),
+    "filterReads": os.path.join(outDir, "calls", strain + "_calledReads.filtered.txt"),
+    "predict": os.path.join(outDir, "preds", strain + ".pred." + str(binSize) + ".txt"),
+    "predToGff": os.path.join(outDir, "display", "preds", strain + "_pred_" + str(binSize) + ".gff"),
+  }
+
+def buildStrain(job):
+  """Brings one strain's chain up to date. Returns (strain, the stages that
+  ran, the error that stopped it)"""
+  strain, pileupFileName, mutationsFileName, filterFileName, outDir, settings = job
+  files = strainFiles(outDir, strain, settings["binSize"])
+  build = Build(os.path.join(outDir, STATE_DIR, strain + ".json"))
+  ran = []
+
+  #The settings are module globals, set here in the worker that uses them
+  callReadsFromFile.SIMPLE_HET_CALL = settings["SIMPLE_HET_CALL"]
+  predict.DELETE_HET = settings["DELETE_HET"]
+  predict.EXTEND_ENDS = settings["EXTEND_ENDS"]
+  predict.TABLE_PRINT = settings["TABLE_PRINT"]
+
+  #Calling reads the filtered pileup, the chain being filterPileup, then
+  #callReadsFromFile
+  stages = [
+    ("filterPileup", [pileupFileName, filterFileName], {}, [filterPileup],
+      filterPileup.filterReads, (pileupFileName, filterFileName, files["filterPileup"])),
+    ("callReadsFromFile", [mutationsFileName, files["filterPileup"]], {"SIMPLE_HET_CALL": settings["SIMPLE_HET_CALL"]}, [callReadsFromFile],
+      callReadsFromFile.callReads, (mutationsFileName, files["filterPileup"], files["callReadsFromFile"])),
+    ("filterReads", [files["callReadsFromFile"], filterFileName], {}, [filterReads],
+      filterReads.filterReads, (files["callReadsFromFile"], filterFileName, files["filterReads"])),
+    ("predict", [files["filterReads"]], predictSettings(settings["binSize"], settings["DELETE_HET"], settings["EXTEND_ENDS"], settings["TABLE_PRINT"]), [predict],
+      predict.predict, (files["filterReads"], files["predict"], strain, settings["binSize"])),
+  ]
+
+  #predToGff reads the rows predict writes with TABLE_PRINT set, so without
+  #it the chain stops at predict
+  if settings["TABLE_PRINT"]:
+    stages.append(("predToGff", [files["predict"]], {}, [predToGff],
+      predToGff.convert, (files["predict"], files["predToGff"])))
+
+  try:
+    for name, inputs, stageSettings, modules, func, args in stages:
+      if build.run(name, inputs, [files[name]], stageSettings, modules, func, *args):
+        ran.append(name)
+    return strain, ran, None
+  except Exception:
+    return strain, ran, traceback.format_exc()
+
+def buildTracks(outDir, binSize, jobs=1):
+  """Writes the JBrowse tracks of every strain's preds and called reads into
+  the display folder with makeTracks, along with a trackList.json listing
+  them, when any of them change. Returns whether it ran"""
+  displayDir = os.path.join(outDir, "display")
+  predsDir = os.path.join(outDir, "preds")
+  callsDir = os.path.join(outDir, "calls")
+  sources = [fileName for kind, fileName in makeTracks.findSources(predsDir, callsDir, binSize)]
+  trackList = os.path.join(displayDir, "trackList.json")
+
+  build = Build(os.path.join(outDir, STATE_DIR, "cohort.json"))
+  return build.run("makeTracks", sources, [trackList], {"binSize": binSize, "sources": [os.path.basename(fileName) for fileName in sources]}, [makeTracks],
+    makeTracks.makeTracks, displayDir, predsDir, callsDir, binSize, jobs, False, True)
+
+def readManifest(manifestFileName):
+  """The (strain, pileup file) pairs of a tab separated manifest. Pileup
+  paths are relative to the manifest"""
+  baseDir = os.path.dirname(os.path.abspath(manifestFileName))
+  strains = []
+
+  with open(manifestFileName) as manifest:
+    for line in manifest:
+      row = line.rstrip('\r\n').split('\t')
+      if not row[0] or row[0].startswith('#'):
+        continue
+      strains.append((row[0], os.path.join(baseDir, row[1])))
+
+  return strains
+
+def buildAll(manifestFileName, mutationsFileName, filterFileName, outDir, settings, jobs=1):
+  """Brings every strain in the manifest and the tracks up to date,
+  jobs strains at a time. Returns a list of (strain, stages run, error)"""
+  for subDir in (STATE_DIR, "piles", "calls", "preds", os.path.join("display", "preds")):
+    if not os.path.isdir(os.path.join(outDir, subDir)):
+      os.makedirs(os.path.join(outDir, subDir))
+
+  mutationsFileName = os.path.abspath(mutationsFileName)
+  filterFileName = os.path.abspath(filterFileName)
+  outDir = os.path.abspath(outDir)
+  jobList = [(strain, pileupFileName, mutationsFileName, filterFileName, outDir, settings) for strain, pileupFileName in readManifest(manifestFileName)]
+
+  with profiling.stage("buildStrains") as stage:
+    if jobs > 1 and len(jobList) > 1:
+      pool = Pool(min(jobs, len(jobList)))
+      try:
+        results = pool.map(buildStrain, jobList, 1)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      results = map(buildStrain, jobList)
+    stage.count(len(jobList))
+
+  if settings["TABLE_PRINT"] and buildTracks(outDir, settings["binSize"], jobs):
+    results.append(("cohort", ["makeTracks"], None))
+
+  return results
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("manifest", help="tab separated strain and raw pileup file per line")
+  parser.add_argument("mutationsFile", help="the mutations table")
+  parser.add_argument("filterFile", help="the positions to keep from the pileups and calls")
+  parser.add_argument("outDir", help="the folder to build into, with piles, calls, preds and display folders")
+  parser.add_argument("-b", "--binSize", type=int, default=predict.DEFAULT_BINSIZE, help="bin size for predictions")
+  parser.add_argument("-d", action="store_true", help="delete heterozygous chromosomes")
+  parser.add_argument("-e", action="store_true", help="extend regions to touch each other")
+  parser.add_argument("-t", action="store_true", help="predict in the rows predToGff reads and go on to make gffs, JBrowse tracks and the track list")
+  parser.add_argument("--binomialHet", action="store_true", help="call het sites from binomials instead of one read of each")
+  parser.add_argument("-j", "--jobs", type=int, default=1, help="number of strains to build at once")
+  args = parser.parse_args()
+
+  settings = predictSettings(args.binSize, args.d, args.e, args.t)
+  settings["SIMPLE_HET_CALL"] = not args.binomialHet
+
+  start = time.time()
+  results = profiling.run("pipeline", buildAll, args.manifest, args.mutationsFile, args.filterFile, args.outDir, settings, args.jobs)
+
+  failed = False
+  for strain, ran, error in results:
+    print strain + '\t' + (', '.join(ran) if ran else "up to date")
+    if error:
+      failed = True
+      sys.stderr.write(strain + " failed:\n" + error)
+
+  print "Built in {:.2f}s".format(time.time() - start)
+  if failed:
+    sys.exit(1)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+'''
+Interval index over prediction files, for looking up which region a site
+falls in across many strains without rereading the pred files
+'''
+
+import os
+import re
+import argparse
+import numpy
+
+import records
+
+#The index sits next to the pred file it was made from, as <pred file>.idx
+SUFFIX = ".idx"
+
+#What a lookup gives for a site no region covers, such as one inside the
+#breakpoint between two regions
+NO_PRED = '-'
+
+#The region summary stats in both pred formats
+STAT_NAMES = ("Number of sites", "N2/Genotyped", "MY14/Genotyped", "Heterozygous/Genotyped", "Unknown/All")
+
+def indexPath(predFileName):
+  return predFileName + SUFFIX
+
+def isIndex(fileName):
+  return fileName.endswith(SUFFIX)
+
+def readRegions(predFileName):
+  """Yields the (chrome, start, end, pred) of each region in a pred file"""
+  for chrome, start, end, pred, stats in readRegionStats(predFileName):
+    yield chrome, start, end, pred
+
+def readRegionStats(predFileName):
+  """Yields the (chrome, start, end, pred, stats) of each region in a pred
+  file, where stats is a list of (name, value) summary stats as predToGff
+  names them. Handles both of predict's formats, as records.readPreds does"""
+  with open(predFileName) as predFile:
+    for block in records.readPreds(predFile):
+      for start, end, pred, stats in zip(block.start.tolist(), block.end.tolist(), block.pred, block.stats):
+        yield block.chrome, start, end, pred, zip(STAT_NAMES, stats)
+
+class PredIndex(object):
+  """The regions of one pred file as sorted start, end and prediction arrays
+  by chromosome. Regions on a chromosome don't overlap, so both starts and
+  ends are sorted and any lookup is a binary search"""
+
+  def __init__(self, chromes):
+    #Chromosome name to (starts, ends, preds)
+    self.chromes = chromes
+
+  @classmethod
+  def build(cls, predFileName):
+    regions = {}
+    with open(predFileName) as predFile:
+      for block in records.readPreds(predFile):
+        regions.setdefault(block.chrome, []).extend(zip(block.start.tolist(), block.end.tolist(), [ord(pred) for pred in block.pred]))
+
+    chromes = {}
+    for chrome, chromeRegions in regions.items():
+      chromeRegions.sort()
+      starts, ends, preds = zip(*chromeRegions)
+      chromes[chrome] = (numpy.array(starts, dtype=numpy.int64), numpy.array(ends, dtype=numpy.int64), numpy.array(preds, dtype=numpy.uint8))
+
+    return cls(chromes)
+
+  @classmethod
+  def load(cls, indexFileName):
+    chromes = {}
+    with open(indexFileName, 'rb') as indexFile:
+      arrays = numpy.load(indexFile)
+      for key in arrays.files:
+        chrome, column = key.rsplit('.', 1)
+        chromes.setdefault(chrome, {})[column] = arrays[key]
+
+    return cls(dict((chrome, (columns["starts"], columns["ends"], columns["preds"])) for chrome, columns in chromes.items()))
+
+  def save(self, indexFileName):
+    arrays = {}
+    for chrome, (starts, ends, preds) in self.chromes.items():
+      arrays[chrome + ".starts"] = starts
+      arrays[chrome + ".ends"] = ends
+      arrays[chrome + ".preds"] = preds
+
+    #Write then rename so a reader never sees half an index
+    with open(indexFileName + ".tmp", 'wb') as indexFile:
+      numpy.savez(indexFile, **arrays)
+    os.rename(indexFileName + ".tmp", indexFileName)
+
+  def lookup(self, chrome, positions):
+    """The prediction at each of positions on chrome, as an array of
+    characters with NO_PRED where no region covers the position"""
+    positions = numpy.asarray(positions, dtype=numpy.int64)
+    found = numpy.empty(len(positions), dtype=numpy.uint8)
+    found.fill(ord(NO_PRED))
+
+    if records.chromeName(chrome) in self.chromes:
+      starts, ends, preds = self.chromes[records.chromeName(chrome)]
+      regions = numpy.searchsorted(starts, positions, 'right') - 1
+      covered = (regions >= 0) & (positions <= ends[numpy.maximum(regions, 0)])
+      found[covered] = preds[regions[covered]]
+
+    return found.view('S1')
+
+  def point(self, chrome, pos):
+    return self.lookup(chrome, [pos])[0]
+
+  def overlaps(self, chrome, start, end):
+    """The (start, end, pred) of each region overlapping start to end"""
+    if records.chromeName(chrome) not in self.chromes:
+      return []
+
+    starts, ends, preds = self.chromes[records.chromeName(chrome)]
+    first = numpy.searchsorted(ends, start, 'left')
+    last = numpy.searchsorted(starts, end, 'right')
+
+    return [(int(starts[i]), int(ends[i]), chr(preds[i])) for i in range(first, last)]
+
+def openIndex(predFileName):
+  """Returns the PredIndex for a pred file, building and saving it next to
+  the file if there isn't one at least as new as the file"""
+  path = indexPath(predFileName)
+
+  if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(predFileName):
+    return PredIndex.load(path)
+
+  index = PredIndex.build(predFileName)
+  index.save(path)
+  return index
+
+def strainName(predFileName):
+  """The strain a pred file is for, from predictStats' <strain>.pred.<binSize>.txt"""
+  return os.path.basename(predFileName).split(".pred")[0]
+
+class Cohort(object):
+  """The indexes of every pred file in a folder, by strain, for asking the
+  same question of all of them at once"""
+
+  def __init__(self, predFolder, binSize=None):
+    self.strains = {}
+
+    for fileName in sorted(os.listdir(predFolder)):
+      if isIndex(fileName) or not fileName.endswith(".txt") or ".pred." not in fileName:
+        continue
+      if binSize is not None and not fileName.endswith(".pred.{}.txt".format(binSize)):
+        continue
+
+      self.strains[strainName(fileName)] = openIndex(os.path.join(predFolder, fileName))
+
+  def point(self, chrome, pos):
+    """The prediction of every strain at one position"""
+    return dict((strain, index.point(chrome, pos)) for strain, index in self.strains.items())
+
+  def lookup(self, chrome, positions):
+    """The predictions of every strain at many positions, as a dictionary of
+    strain to an array of prediction characters"""
+    return dict((strain, index.lookup(chrome, positions)) for strain, index in self.strains.items())
+
+  def overlaps(self, chrome, start, end):
+    """The regions of every strain overlapping start to end"""
+    return dict((strain, index.overlaps(chrome, start, end)) for strain, index in self.strains.items())
+
+def parsePos(pos):
+  """Reads a position like 3200000, 3,200,000, 3200kb or 3.2Mb"""
+  match = re.match(r"^([\d,.]+)\s*(kb|mb)?$", pos.strip(), re.I)
+  if not match:
+    raise ValueError("Not a position: " + pos)
+
+  scale = {None: 1, "kb": 1000, "mb": 1000000}[match.group(2).lower() if match.group(2) else None]
+  return int(round(float(match.group(1).replace(',', '')) * scale))
+
+def parseLocus(locus):
+  """Reads chrome:pos or chrome:start-end. Returns (chrome, start, end)"""
+  chrome, positions = locus.rsplit(':', 1)
+  if '-' in positions:
+    start, end = positions.split('-', 1)
+    return chrome, parsePos(start), parsePos(end)
+
+  pos = parsePos(positions)
+  return chrome, pos, pos
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("predFolder", help="the folder of pred files, indexes are saved next to them")
+  parser.add_argument("loci", nargs="*", help="chrome:pos or chrome:start-end to look up, like CHROMOSOME_IV:3.2Mb")
+  parser.add_argument("-b", "--binSize", type=int, help="only use pred files for this bin size")
+  args = parser.parse_args()
+
+  cohort = Cohort(args.predFolder, args.binSize)
+
+  for locus in args.loci:
+    chrome, start, end = parseLocus(locus)
+    print locus
+
+    for strain, regions in sorted(cohort.overlaps(chrome, start, end).items()):
+      print '\t'.join([strain] + (["{}-{}:{}".format(*region) for region in regions] or [NO_PRED]))
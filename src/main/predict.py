@@ -5,10 +5,18 @@ djc 3/31/14
 '''
 
 import math
+import time
 import argparse
-import csv
+import numpy
 import util
+import records
+import siteStore
+import callStore
+import profiling
+from array import array
+from cStringIO import StringIO
 from collections import defaultdict
+from multiprocessing import Pool
 
 #Table format (true) or gff format (false)
 TABLE_PRINT = False
@@ -21,13 +29,16 @@ EXTEND_ENDS = False
 
 DEFAULT_BINSIZE = 100
 
+#The (sites, tallies) by chromosome shared by the bin sizes of a sweep
+sweepSites = None
+
 chromeLengths = {"I" : 15072000, "II" : 15279000, "III" : 13784000, "IV" : 17494000, "V" : 20920000, "X" : 17719000}
 
 class Region:
 	prevPred = "-"
 	nextPred = "-"
 	
-	def __init__(self, strain, chrome, prevRegion, start, earlyEnd, lateEnd, pred, sites):
+	def __init__(self, strain, chrome, prevRegion, start, earlyEnd, lateEnd, pred, counts, first, last):
 		self.strain = strain
 		self.chrome = chrome
 		self.start = start
@@ -39,34 +50,21 @@ class Region:
 			prevRegion.nextPred = pred
 			self.prevPred = prevRegion.pred
 		
-		#Calculate summary stats
+		#Calculate summary stats for sites[first:last] from the running counts
 		self.size = (earlyEnd - start) / 1000
 		
-		self.numSites = 0
-		n = 0
-		m = 0
-		h = 0
-		u = 0
-	
-		for site in sites:
-			#Number of Us, plus this site
-			self.numSites = self.numSites + site[2] + 1
-	
-			u = u + site[2]
-	
-			if(site[0] == 'N'):
-				n = n + 1
-			elif(site[0] == 'M'):
-				m = m+1
-			else:
-				h = h + 1
+		first, last, step = slice(first, last).indices(len(counts))
+		n, m, h, u = counts.counts(first, max(first, last))
+
+		#Every n/m/h site plus the Us before it
+		self.numSites = n + m + h + u
 	
 		#The U counts are for sites before the given n/m/h site
 		#So don't count for the first site unless it is the start
 		#of the chromosome
 		if start != 0:
-			self.numSites = self.numSites - sites[0][2]
-			u = u - sites[0][2]
+			self.numSites = self.numSites - counts.uCount(first)
+			u = u - counts.uCount(first)
 	
 		#For N,M,H do percentage of genotyped
 		self.percentN = n / float(self.numSites - u)
@@ -104,49 +102,207 @@ def predict(inFileName, outFileName, strain, binSize):
 	window of the given binSize.
 	Returns a tuple with the number of chromosomes and regions predicted"""
 
-	with open(inFileName) as sitesFile, open(outFileName, 'w') as predFile:
-		#Load whole file into memory since it is only a couple of MBs
-		reader = csv.reader(sitesFile, delimiter='\t')
-		#dictionary of lists
-		chromeMap = defaultdict(list)
-
-		#We really only want to work with sites that have been called as N,M,H
-		#so just count up the number of U sites between the more meaningful
-		#sites for summary stats later
-		uCount = 0
-		for row in reader:
-			if(row[2] == 'U'):
-				uCount = uCount + 1
-			else:
-				chromeMap[row[0]].append((row[2], int(row[1]), uCount)) 
-				uCount = 0
-
-		#Write header
-		if TABLE_PRINT:
-			predFile.write(','.join(("Strain", "Chromosome", "Start", "End", "Size (kbp)", "Number of SNPs", "N2/Genotyped", "MY14/Genotyped", "Heterozygous/Genotyped", "Incongruities/Genotyped", "Unknown/All", "Previous Prediction", "Prediction", "Next Prediction", "Link")) + '\n')
+	with open(outFileName, 'w') as predFile, profiling.stage("predict") as stage:
+		stage.read(inFileName)
+		writeHeader(predFile)
+		thresholds = binThresholds(binSize)
+
+		#Predict a chromosome at a time as the file is read, using the binary
+		#store of the calls if there is one
+		store = callStore.openCalls(inFileName)
+		if store:
+			with store:
+				chromeRegions = predictChromes(strain, store.genotypedSites(), binSize, thresholds)
+		elif isGrouped(inFileName):
+			chromeRegions = predictChromes(strain, streamSites(inFileName), binSize, thresholds)
 		else:
-			predFile.write('\t'.join(("Chromosome", "Breakpoint Lower", "Breakpoint Upper", "Prediction", "Number of SNPs", "N2/Genotyped", "MY14/Genotyped", "Heterozygous/Genotyped", "Unknown/All")) + '\n')
-			
-		#Gather up thresholds for the binSize and binSize/2 because sometimes
-		#we break the window in half for more positional knowledge
-		fullBinThresh = util.cutoffs(binSize)
-		halfBinThresh = util.cutoffs(binSize / 2)
-		thresholds = (fullBinThresh[0], fullBinThresh[1], halfBinThresh[0], halfBinThresh[1])
-
-		#The total number of chromosomes and regions predicted
-		chromeCount = 0
-		regCount = 0
-
-		#Make predictions for each chromosome
-		for chrome in sorted(chromeMap.keys()):
-			chromes, regs = predictChrome(strain, chrome, chromeMap[chrome], binSize, thresholds, predFile)
+			#The file is not grouped by chromosome, so load it all first
+			chromeRegions = predictChromes(strain, readSites(inFileName).iteritems(), binSize, thresholds)
+
+		return writeRegions(predFile, chromeRegions)
+
+def sweep(inFileName, outFileNames, strain, binSizes, jobs=1):
+	"""Predicts for each of binSizes, saving to the matching outFileNames,
+	from a single read of the site calls. The sites and their running counts
+	are shared by every bin size, and up to jobs bin sizes are predicted at
+	once. A single bin size is just streamed through predict.
+	Returns the seconds spent loading the sites and a list of
+	(binSize, chromosomes, regions, seconds) for each bin size"""
+	global sweepSites
+
+	if len(binSizes) == 1:
+		start = time.time()
+		chromes, regs = predict(inFileName, outFileNames[0], strain, binSizes[0])
+		return 0.0, [(binSizes[0], chromes, regs, time.time() - start)]
+
+	start = time.time()
+	with profiling.stage("loadSites") as stage:
+		stage.read(inFileName)
+		chromeMap = loadSites(inFileName)
+		tallies = dict((chrome, (VoteCounts(sites), SiteCounts(sites))) for chrome, sites in chromeMap.items())
+		stage.count(sum(len(sites) for sites in chromeMap.values()))
+	loadTime = time.time() - start
+
+	#Forked workers see the loaded sites without them being copied over
+	sweepSites = (chromeMap, tallies)
+	jobList = [(outFileName, strain, binSize) for outFileName, binSize in zip(outFileNames, binSizes)]
+
+	try:
+		if jobs > 1:
+			pool = Pool(min(jobs, len(jobList)))
+			try:
+				results = pool.map(predictLoaded, jobList)
+			finally:
+				pool.close()
+				pool.join()
+		else:
+			results = map(predictLoaded, jobList)
+	finally:
+		sweepSites = None
+
+	return loadTime, results
+
+def predictLoaded(job):
+	"""Predicts one (outFileName, strain, binSize) job of a sweep from the
+	sites in sweepSites. Returns (binSize, chromosomes, regions, seconds)"""
+	outFileName, strain, binSize = job
+	chromeMap, tallies = sweepSites
+	start = time.time()
+
+	with open(outFileName, 'w') as predFile:
+		writeHeader(predFile)
+		chromeRegions = predictChromes(strain, chromeMap.iteritems(), binSize, binThresholds(binSize), tallies)
+		chromes, regs = writeRegions(predFile, chromeRegions)
+
+	return binSize, chromes, regs, time.time() - start
+
+def writeHeader(predFile):
+	if TABLE_PRINT:
+		predFile.write(','.join(("Strain", "Chromosome", "Start", "End", "Size (kbp)", "Number of SNPs", "N2/Genotyped", "MY14/Genotyped", "Heterozygous/Genotyped", "Incongruities/Genotyped", "Unknown/All", "Previous Prediction", "Prediction", "Next Prediction", "Link")) + '\n')
+	else:
+		predFile.write('\t'.join(("Chromosome", "Breakpoint Lower", "Breakpoint Upper", "Prediction", "Number of SNPs", "N2/Genotyped", "MY14/Genotyped", "Heterozygous/Genotyped", "Unknown/All")) + '\n')
+
+def binThresholds(binSize):
+	"""Gather up thresholds for the binSize and binSize/2 because sometimes
+	we break the window in half for more positional knowledge"""
+	fullBinThresh = util.cutoffs(binSize)
+	halfBinThresh = util.cutoffs(binSize / 2)
+	return (fullBinThresh[0], fullBinThresh[1], halfBinThresh[0], halfBinThresh[1])
+
+def writeRegions(predFile, chromeRegions):
+	"""Writes the regions from predictChromes in chromosome order.
+	Returns the total number of chromosomes and regions predicted"""
+	chromeCount = 0
+	regCount = 0
+
+	with profiling.stage("writeRegions") as stage:
+		for chrome in sorted(chromeRegions.keys()):
+			chromes, regs, regions = chromeRegions[chrome]
+			predFile.write(regions)
 			chromeCount += chromes
 			regCount += regs
-			
-		return chromeCount, regCount
 
-def predictChrome(strain, chrome, sites, binSize, thresholds, predFile):
+		stage.count(regCount)
+		
+	return chromeCount, regCount
+
+def predictChromes(strain, chromeSites, binSize, thresholds, tallies=None):
+	"""Makes predictions for each (chrome, sites) in turn, keeping only the
+	text of each chromosome's regions so its sites can be freed before the
+	next chromosome is read. tallies can map chromosomes to their
+	(VoteCounts, SiteCounts) when they have already been counted. Each
+	chromosome must come up once. Returns a dictionary of chrome to the
+	chromosome and region counts from predictChrome along with the region
+	text"""
+
+	chromeRegions = {}
+
+	for chrome, sites in chromeSites:
+		regions = StringIO()
+		with profiling.stage("predictChrome") as stage:
+			chromes, regs = predictChrome(strain, chrome, sites, binSize, thresholds, regions, tallies[chrome] if tallies else None)
+			stage.count(len(sites))
+		chromeRegions[chrome] = (chromes, regs, regions.getvalue())
+
+		#Drop this chromosome before the next one is read
+		del sites
+
+	return chromeRegions
+
+def loadSites(inFileName):
+	"""Reads all the sites of a called reads file into a dictionary of
+	columnar site stores by chromosome, from its binary store if it has one"""
+	store = callStore.openCalls(inFileName)
+	if store:
+		with store:
+			return dict(store.genotypedSites())
+
+	return readSites(inFileName)
+
+def genotypedBlocks(blocks):
+	"""Yields (chrome, calls, positions, uCounts) for the sites that are
+	not U in each block of called reads, where uCounts is the number of U
+	sites skipped before each one. As in callStore.genotypedSites, the U
+	sites are counted on from the previous block, even across chromosomes"""
+
+	#We really only want to work with sites that have been called as N,M,H
+	#so just count up the number of U sites between the more meaningful
+	#sites for summary stats later
+	uCount = 0
+	for block in blocks:
+		genotyped = numpy.flatnonzero(block.call != ord('U'))
+		if len(genotyped) == 0:
+			uCount = uCount + len(block.call)
+			continue
+
+		uCounts = numpy.diff(numpy.concatenate(([-1 - uCount], genotyped))) - 1
+		uCount = len(block.call) - 1 - genotyped[-1]
+
+		yield block.chrome, block.call[genotyped], block.pos[genotyped], uCounts
+
+def isGrouped(inFileName):
+	"""Whether a called reads text file keeps each chromosome's lines
+	together, so streamSites gives each chromosome once"""
+	blocks = util.chromeBlocks(inFileName, 0)
+	return blocks is not None and len(set(records.chromeName(chrome) for chrome, start, end in blocks)) == len(blocks)
+
+def streamSites(inFileName):
+	"""Reads a called reads text file a chromosome at a time, yielding
+	(chrome, sites) with the columnar site store for each run of lines
+	on the same chromosome"""
+
+	with open(inFileName) as sitesFile:
+		chrome = None
+		sites = None
+
+		for blockChrome, calls, positions, uCounts in genotypedBlocks(records.readCalls(sitesFile)):
+			if blockChrome != chrome:
+				if sites:
+					yield chrome, sites
+				chrome = blockChrome
+				sites = siteStore.Sites()
+
+			sites.extend(calls, positions, uCounts)
+
+		if sites:
+			yield chrome, sites
+
+def readSites(inFileName):
+	"""Reads a whole called reads text file into a dictionary of columnar
+	site stores by chromosome"""
+
+	with open(inFileName) as sitesFile:
+		#dictionary of columnar site stores
+		chromeMap = defaultdict(siteStore.Sites)
+
+		for chrome, calls, positions, uCounts in genotypedBlocks(records.readCalls(sitesFile)):
+			chromeMap[chrome].extend(calls, positions, uCounts)
+
+		return chromeMap
+
+def predictChrome(strain, chrome, sites, binSize, thresholds, predFile, tallies=None):
 	"""Walks through the sites and makes predictions, printing them out to predFile.
+	tallies is the (VoteCounts, SiteCounts) for the sites if already counted.
 	Also returns a tuple with:
 	 0 or 1 in the first position for whether this chromosome was included in our predictions
 	 the number of regions predicted on this chromosome"""
@@ -165,11 +321,15 @@ def predictChrome(strain, chrome, sites, binSize, thresholds, predFile):
 	
 	#Link previous and next predictions
 	prevRegion = None
+
+	if tallies:
+		votes, counts = tallies
+	else:
+		votes = VoteCounts(sites)
+		counts = SiteCounts(sites)
 	
 	while currEnd < len(sites):
-		window = sites[currStart:currEnd]
-
-		newPred, halfCall = call(window, thresholds, currPred)
+		newPred, halfCall = call(votes, currStart, currEnd, thresholds, currPred)
 		
 		if(DELETE_HET and newPred == 'H'):
 			foundHet = True
@@ -178,6 +338,8 @@ def predictChrome(strain, chrome, sites, binSize, thresholds, predFile):
 		if currPred and currPred != newPred:
 			#Then we have had a transition
 
+			window = sites[currStart:currEnd]
+
 			if(halfCall):
 				#Only look in first half of window for cutoff
 				window = window[:(binSize/2)]
@@ -187,7 +349,7 @@ def predictChrome(strain, chrome, sites, binSize, thresholds, predFile):
 
 			currStart = currStart + cut
 
-			currRegion = Region(strain, chrome, prevRegion, getStart(lastCut, sites), getEarlyEnd(currStart, sites), getLateEnd(currStart, sites), currPred, sites[lastCut:currStart - 1])
+			currRegion = Region(strain, chrome, prevRegion, getStart(lastCut, sites), getEarlyEnd(currStart, sites), getLateEnd(currStart, sites), currPred, counts, lastCut, currStart - 1)
 			regions.append(currRegion)
 
 			lastCut = currStart
@@ -206,7 +368,7 @@ def predictChrome(strain, chrome, sites, binSize, thresholds, predFile):
 		return 0, 0
 	else:
 		#Now we are at the end, add the last prediction
-		regions.append(Region(strain, chrome, prevRegion, getStart(lastCut, sites), chromeLengths[chrome], chromeLengths[chrome], currPred, sites[lastCut:currStart - 1]))
+		regions.append(Region(strain, chrome, prevRegion, getStart(lastCut, sites), chromeLengths[chrome], chromeLengths[chrome], currPred, counts, lastCut, currStart - 1))
 		
 		for region in regions:
 			predFile.write(region.toString() + '\n')
@@ -215,7 +377,7 @@ def predictChrome(strain, chrome, sites, binSize, thresholds, predFile):
 	
 	
 def midpoint(position, sites):
-	return (sites[position - 1][1] + sites[position][1]) / 2
+	return (sites.pos(position - 1) + sites.pos(position)) / 2
 
 def getStart(start, sites):
 	"""Gets the start of a region based on the last cutting point"""
@@ -225,25 +387,25 @@ def getStart(start, sites):
 		if EXTEND_ENDS:
 			return midpoint(start, sites)
 		else:
-			return sites[start][1]
+			return sites.pos(start)
 		
 def getEarlyEnd(end, sites):
 	if EXTEND_ENDS:
 		return midpoint(end, sites)
 	else:
-		return sites[end - 1][1]
+		return sites.pos(end - 1)
 	
 def getLateEnd(end, sites):
 	if EXTEND_ENDS:
 		return midpoint(end, sites)
 	else:
-		return sites[end][1]
+		return sites.pos(end)
 
 def findNextDiff(sites, index, curr):
 	"""Returns the index of the next site that is different from the given
 	one, or an index out of range if no different site is found"""
 	while index < len(sites):
-		if sites[index][0] != curr:
+		if sites.call(index) != curr:
 			break
 		else:
 			index = index + 1
@@ -251,17 +413,27 @@ def findNextDiff(sites, index, curr):
 	return index
 
 def findBestCut(sequence, oldPred, newPred):
-	"""Finds the cut point to transition from oldPred to newPred"""
+	"""Finds the cut point to transition from oldPred to newPred.
+	Walks the sequence once, keeping a running count of the sites that
+	disagree with oldPred before the cut plus those that disagree with
+	newPred after it"""
 	bestCut = 0
 	bestWrong = len(sequence) + 1
 
-	for i in range(len(sequence)):
-		wrong = callWrong(sequence[:i], oldPred) + callWrong(sequence[i:], newPred)
+	#With the cut at 0 every site is on the newPred side
+	wrong = callWrong(sequence, newPred)
 
+	for i, site in enumerate(sequence.callView()):
 		if wrong < bestWrong:
 			bestCut = i
 			bestWrong = wrong
-			
+
+		#Moving the cut past this site puts it on the oldPred side
+		if oldPred != 'H' and site != oldPred:
+			wrong = wrong + 1
+		if newPred != 'H' and site != newPred:
+			wrong = wrong - 1
+
 	return bestCut
 
 def callWrong(sequence, pred):
@@ -271,31 +443,91 @@ def callWrong(sequence, pred):
 
 	#No wrong calls for hetero
 	if(pred != 'H'):
-		for site in sequence:
-			if(site[0] != pred):
+		for site in sequence.callView():
+			if(site != pred):
 				wrong = wrong + 1
 
 	return wrong
 
 
-def call(window, thresholds, currPred):
-	ret = callWindow(window, thresholds[0], thresholds[1])
+class VoteCounts:
+	"""Running total of the N votes over a chromosome's sites, so the votes
+	in any window, or half of one, come from two lookups instead of a recount
+	as the window slides along. N sites are one vote and H sites half a vote,
+	kept as half votes so the totals stay integers"""
+
+	def __init__(self, sites):
+		self.halfVotes = array('i', [0])
+		total = 0
+
+		for site in sites.callView():
+			if site == 'N':
+				total = total + 2
+			elif site == 'H':
+				total = total + 1
+
+			self.halfVotes.append(total)
+
+	def votes(self, start, end):
+		"""Returns the N votes for sites[start:end]"""
+		return (self.halfVotes[end] - self.halfVotes[start]) / 2.0
+
+class SiteCounts:
+	"""Running totals of the N, M, H and U counts over a chromosome's sites,
+	so a region's summary stats come from differences instead of a walk over
+	its sites. The U total for a site counts the U sites skipped before it"""
+
+	def __init__(self, sites):
+		self.nCounts = array('i', [0])
+		self.mCounts = array('i', [0])
+		self.hCounts = array('i', [0])
+		self.uCounts = array('i', [0])
+		n = 0
+		m = 0
+		h = 0
+		u = 0
+
+		for i, site in enumerate(sites.callView()):
+			u = u + sites.uCount(i)
+
+			if(site == 'N'):
+				n = n + 1
+			elif(site == 'M'):
+				m = m + 1
+			else:
+				h = h + 1
+
+			self.nCounts.append(n)
+			self.mCounts.append(m)
+			self.hCounts.append(h)
+			self.uCounts.append(u)
+
+	def __len__(self):
+		return len(self.nCounts) - 1
+
+	def counts(self, start, end):
+		"""Returns a tuple of the N, M, H and U counts for sites[start:end]"""
+		return (self.nCounts[end] - self.nCounts[start], self.mCounts[end] - self.mCounts[start],
+			self.hCounts[end] - self.hCounts[start], self.uCounts[end] - self.uCounts[start])
+
+	def uCount(self, i):
+		"""Returns the number of U sites skipped before site i"""
+		if i < 0 or i >= len(self):
+			raise IndexError("site index out of range")
+		return self.uCounts[i + 1] - self.uCounts[i]
+
+def call(votes, start, end, thresholds, currPred):
+	ret = callWindow(votes, start, end, thresholds[0], thresholds[1])
 
 	if(ret == 'H'):
 		#Look more closely into het calls
-		return callHetero(window, thresholds, currPred)
+		return callHetero(votes, start, end, thresholds, currPred)
 	else:
 		return ret, False
 		
 
-def callWindow(window, mThresh, nThresh):
-	nVotes = 0.0
-
-	for site in window:
-		if site[0] == 'N':
-			nVotes = nVotes + 1
-		elif site[0] == 'H':
-			nVotes = nVotes + 0.5
+def callWindow(votes, start, end, mThresh, nThresh):
+	nVotes = votes.votes(start, end)
 
 	if nVotes < mThresh:
 		return 'M'
@@ -304,21 +536,19 @@ def callWindow(window, mThresh, nThresh):
 	else:
 		return 'H'
 
-def callHetero(window, thresholds, currPred):
+def callHetero(votes, start, end, thresholds, currPred):
 	"""We were finding that het calls were too liberal in the case
 	that the first half was N, and the second half was M (or vice versa).
 	So now divide a het window in half and proceed based on the content of
 	each half."""
 
-	half = len(window) / 2;
-	first = window[:half]
+	half = start + (end - start) / 2;
 
-	firstCall = callWindow(first, thresholds[2], thresholds[3])
+	firstCall = callWindow(votes, start, half, thresholds[2], thresholds[3])
 
 	if(firstCall == 'H'):
 		#What we call depends on the second window
-		second = window[half:]
-		secondCall = callWindow(second, thresholds[2], thresholds[3])
+		secondCall = callWindow(votes, half, end, thresholds[2], thresholds[3])
 
 		if(secondCall == 'H'):
 			#Okay we believe you, the whole window is het
@@ -344,6 +574,8 @@ if __name__ == '__main__':
 	parser.add_argument("-e",  action="store_true", help="extend regions to touch each other")
 	parser.add_argument("-t",  action="store_true", help="print in the format needed for making the table, as opposed to the gffs")
 	parser.add_argument("-b",  "--binSize", type=int, help="bin size for predictions")
+	parser.add_argument("-s",  "--sweep", type=int, nargs="+", help="bin sizes to predict from one read of callsFile, saving each to outputFile.pred.<binSize>.txt")
+	parser.add_argument("-j",  "--jobs", type=int, default=1, help="number of sweep bin sizes to predict at once")
 	args = parser.parse_args()
 	
 	DELETE_HET = args.d
@@ -354,5 +586,14 @@ if __name__ == '__main__':
 	if args.binSize:
 		binSize = args.binSize
 	
-	predict(args.callsFile, args.outputFile, args.strain, binSize)
+	if args.sweep:
+		outFileNames = [args.outputFile + ".pred." + str(size) + ".txt" for size in args.sweep]
+		loadTime, results = profiling.run("predict", sweep, args.callsFile, outFileNames, args.strain, args.sweep, args.jobs)
+
+		print "Loaded sites in {:.2f}s".format(loadTime)
+		print '\t'.join(("Bin size", "Chromosomes", "Regions", "Seconds"))
+		for size, chromes, regs, seconds in results:
+			print '\t'.join((str(size), str(chromes), str(regs), "{:.2f}".format(seconds)))
+	else:
+		profiling.run("predict", predict, args.callsFile, args.outputFile, args.strain, binSize)
 	
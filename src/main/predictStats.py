@@ -5,26 +5,104 @@ djc 7/15/14
 '''
 
 import predict
+import profiling
 
 import os
 import sys
+import argparse
+import traceback
+from multiprocessing import Pool
 
-if __name__ == '__main__':
-  inFolder, outFolder, binSize = sys.argv[1:]
-  
-  chromeCount = 0
-  regCount = 0
-  
-  for readFile in os.listdir(inFolder):
+def findJobs(inFolder, outFolder, binSizes):
+  """Lists the predictions to run for each called reads file in inFolder,
+  as (readFile, outFiles, strain, binSizes) tuples with an outFile per
+  bin size"""
+  jobs = []
+
+  for readFile in sorted(os.listdir(inFolder)):
     if readFile.endswith(".txt"):
       base = readFile.replace("_calledReads.filtered.txt", "")
-      outFile = os.path.join(outFolder, base + ".pred." + binSize + ".txt")
+      outFiles = [os.path.join(outFolder, base + ".pred." + str(binSize) + ".txt") for binSize in binSizes]
       readFile = os.path.join(inFolder, readFile)
-      #print outFile
-      
-      chromes, regs = predict.predict(readFile, outFile, base, binSize)
-      chromeCount += chromes
-      regCount += regs
-      
-  print "Chromosomes: " + str(chromeCount)
-  print "Regions: " + str(regCount)
+      #print outFiles
+
+      jobs.append((readFile, outFiles, base, binSizes))
+
+  return jobs
+
+def predictFile(job):
+  """Runs a single prediction job, reading the file once for all its bin
+  sizes. Returns the read file with either the (load time, results) from
+  predict.sweep or the error that stopped it"""
+  readFile = job[0]
+
+  try:
+    return readFile, predict.sweep(*job), None
+  except Exception:
+    return readFile, None, traceback.format_exc()
+
+def predictAll(jobs, numJobs):
+  """Predicts every job, numJobs at a time. Returns the total seconds spent
+  loading sites, a dictionary of bin size to the total [chromosomes, regions,
+  seconds] predicted, and the (readFile, error) pairs for any jobs that
+  failed"""
+  loadTime = 0.0
+  totals = {}
+  failures = []
+
+  if numJobs > 1:
+    pool = Pool(numJobs)
+    results = pool.imap(predictFile, jobs)
+  else:
+    pool = None
+    results = (predictFile(job) for job in jobs)
+
+  try:
+    with profiling.stage("predictAll") as stage:
+      stage.read(*[job[0] for job in jobs])
+      stage.count(len(jobs))
+
+      for readFile, counts, error in results:
+        if error:
+          sys.stderr.write("Prediction failed for " + readFile + "\n" + error)
+          failures.append((readFile, error))
+        else:
+          fileLoadTime, sizeResults = counts
+          loadTime += fileLoadTime
+          for binSize, chromes, regs, seconds in sizeResults:
+            total = totals.setdefault(binSize, [0, 0, 0.0])
+            total[0] += chromes
+            total[1] += regs
+            total[2] += seconds
+  finally:
+    if pool:
+      pool.close()
+      pool.join()
+
+  return loadTime, totals, failures
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument("inFolder", help="the folder of called reads files")
+  parser.add_argument("outFolder", help="the folder to save predictions to")
+  parser.add_argument("binSizes", type=int, nargs="+", help="bin sizes for predictions, more than one sweeps them all from one read of each file")
+  parser.add_argument("-j", "--jobs", type=int, default=1, help="number of strains to predict at once")
+  args = parser.parse_args()
+
+  loadTime, totals, failures = profiling.run("predictStats", predictAll, findJobs(args.inFolder, args.outFolder, args.binSizes), args.jobs)
+
+  if len(args.binSizes) == 1:
+    chromeCount, regCount, seconds = totals.get(args.binSizes[0], [0, 0, 0.0])
+    print "Chromosomes: " + str(chromeCount)
+    print "Regions: " + str(regCount)
+  else:
+    #Timing summary for the sweep
+    print "Loaded sites in {:.2f}s".format(loadTime)
+    print '\t'.join(("Bin size", "Chromosomes", "Regions", "Seconds"))
+    for binSize in args.binSizes:
+      chromeCount, regCount, seconds = totals.get(binSize, [0, 0, 0.0])
+      print '\t'.join((str(binSize), str(chromeCount), str(regCount), "{:.2f}".format(seconds)))
+
+  if failures:
+    print "Failed: " + str(len(failures))
+    sys.exit(1)
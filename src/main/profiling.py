@@ -0,0 +1,148 @@
+'''
+Opt in stage timing for the pipeline scripts
+
+Set CONVERSION_PROFILE to a file name and each script's entry point records
+the wall time, rows, bytes read and peak RSS of its stages, writing them as
+a JSON report there when it finishes. {script} and {pid} in the name are
+filled in, so one setting can cover a whole pipeline. Set CONVERSION_CPROFILE
+as well to also save cProfile stats of the run there.
+
+When CONVERSION_PROFILE is not set, stage() hands back one shared object
+whose methods do nothing, so the hooks cost a call each.
+
+Stages run in worker processes are not collected. Their peak RSS shows up
+in the report as the children's peak.
+'''
+
+import os
+import sys
+import json
+import time
+import resource
+
+REPORT_FILE = os.environ.get("CONVERSION_PROFILE")
+CPROFILE_FILE = os.environ.get("CONVERSION_CPROFILE")
+
+#Stages finished so far in this process, in the order they finished
+stages = []
+
+class Stage(object):
+  """Times a with block and keeps the rows and bytes it was given"""
+
+  __slots__ = ('name', 'start', 'seconds', 'rows', 'bytes', 'peakRss')
+
+  def __init__(self, name):
+    self.name = name
+    self.rows = 0
+    self.bytes = 0
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *args):
+    self.seconds = time.time() - self.start
+    self.peakRss = peakRss()
+    stages.append(self)
+    return False
+
+  def count(self, rows=0, bytes=0):
+    self.rows = self.rows + rows
+    self.bytes = self.bytes + bytes
+
+  def read(self, *fileNames):
+    """Counts the size of each file as bytes read"""
+    for fileName in fileNames:
+      self.bytes = self.bytes + os.path.getsize(fileName)
+
+  def lines(self, iterable):
+    """Passes iterable through, counting each item as a row"""
+    for item in iterable:
+      self.rows = self.rows + 1
+      yield item
+
+  def toDict(self):
+    return {
+      "name": self.name,
+      "seconds": self.seconds,
+      "rows": self.rows,
+      "rowsPerSecond": self.rows / self.seconds if self.seconds else None,
+      "bytes": self.bytes,
+      "peakRssKb": self.peakRss,
+    }
+
+class NullStage(object):
+  """Stands in for a Stage when profiling is off"""
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+  def count(self, rows=0, bytes=0):
+    pass
+
+  def read(self, *fileNames):
+    pass
+
+  def lines(self, iterable):
+    return iterable
+
+nullStage = NullStage()
+
+def enabled():
+  return bool(REPORT_FILE)
+
+def stage(name):
+  """A context manager timing the named stage, when profiling is on"""
+  if REPORT_FILE:
+    return Stage(name)
+  return nullStage
+
+def peakRss(who=resource.RUSAGE_SELF):
+  """Peak resident set size in KB"""
+  return resource.getrusage(who).ru_maxrss
+
+def run(script, func, *args, **kwargs):
+  """Runs a script's entry point, under cProfile if asked, and writes the
+  report of its stages once it returns or fails"""
+  if not REPORT_FILE:
+    return func(*args, **kwargs)
+
+  profiler = None
+  if CPROFILE_FILE:
+    import cProfile
+    profiler = cProfile.Profile()
+
+  start = time.time()
+  error = None
+  try:
+    if profiler:
+      return profiler.runcall(func, *args, **kwargs)
+    return func(*args, **kwargs)
+  except BaseException as e:
+    error = repr(e)
+    raise
+  finally:
+    seconds = time.time() - start
+    if profiler:
+      profiler.dump_stats(CPROFILE_FILE.format(script=script, pid=os.getpid()))
+    writeReport(script, seconds, error)
+
+def writeReport(script, seconds, error=None):
+  report = {
+    "script": script,
+    "argv": sys.argv,
+    "seconds": seconds,
+    "peakRssKb": peakRss(),
+    "peakChildRssKb": peakRss(resource.RUSAGE_CHILDREN),
+    "error": error,
+    "stages": [finished.toDict() for finished in stages],
+  }
+  if CPROFILE_FILE:
+    report["cProfile"] = CPROFILE_FILE.format(script=script, pid=os.getpid())
+
+  with open(REPORT_FILE.format(script=script, pid=os.getpid()), 'w') as reportFile:
+    json.dump(report, reportFile, indent=2, sort_keys=True)
+    reportFile.write('\n')
@@ -0,0 +1,178 @@
+'''
+Bulk parsers for the tab separated files the pipeline passes along: mpileups,
+mutation tables, called reads, filter and candidate sites files and pred files
+
+Lines are taken BLOCK_ROWS at a time and split all at once, with numeric
+columns converted by numpy rather than a row at a time. Each parser takes an
+iterable of lines, such as an open file, and yields blocks of rows on one
+chromosome as typed columns: numpy arrays for numbers and calls, lists for
+text. A chromosome's rows can come in several blocks one after another.
+Chromosome names are given without the CHROMOSOME_ prefix.
+'''
+
+import itertools
+import numpy
+from collections import namedtuple
+
+#Lines split at a time. Much bigger blocks parse slower, as they no longer
+#fit in the CPU caches
+BLOCK_ROWS = 4096
+
+PREFIX = "CHROMOSOME_"
+
+#pos, n, m and p are int32 arrays and call a uint8 array of call characters
+Calls = namedtuple("Calls", "chrome pos call n m p")
+
+#pos is an int32 array, the rest lists of strings
+Mutations = namedtuple("Mutations", "chrome name kind strain pos nBase mBase")
+
+#pos and depth are int32 arrays, the rest lists of strings
+Pileup = namedtuple("Pileup", "chrome pos ref depth bases quals")
+
+#pos is an int32 array
+Positions = namedtuple("Positions", "chrome pos")
+
+#start, end and upper are int64 arrays, pred a list of prediction characters
+#and stats a list of tuples of the predIndex.STAT_NAMES values as written.
+#A region runs from start to end. upper is where the breakpoint after it
+#ends, which in predict's default layout is just the end
+Preds = namedtuple("Preds", "chrome start end upper pred stats")
+
+def chromeName(chrome):
+  """Chromosome names are kept without the CHROMOSOME_ prefix"""
+  return chrome[len(PREFIX):] if chrome.startswith(PREFIX) else chrome
+
+def splitLines(lines, numColumns):
+  """Splits lines into their first numColumns lists of fields. When every
+  line has the same number of fields, at least numColumns, as is normal,
+  they are all split in one go. Otherwise blank lines are dropped and each
+  line is split alone, short lines padded with empty fields"""
+  text = ''.join(lines)
+  if '\r' in text:
+    text = text.replace('\r', '')
+  if not text.endswith('\n'):
+    text = text + '\n'
+
+  #Count the tabs on each line
+  chars = numpy.frombuffer(text, dtype=numpy.uint8)
+  tabsBefore = numpy.searchsorted(numpy.flatnonzero(chars == ord('\t')), numpy.flatnonzero(chars == ord('\n')))
+  tabsOn = numpy.diff(numpy.concatenate(([0], tabsBefore)))
+
+  width = tabsOn[0] + 1
+  if len(tabsOn) == len(lines) and width >= numColumns and (tabsOn == width - 1).all():
+    fields = text[:-1].replace('\n', '\t').split('\t')
+    return [fields[column::width] for column in range(numColumns)]
+
+  rows = [(line.rstrip('\r\n').split('\t') + [''] * numColumns)[:numColumns] for line in lines if line.strip()]
+  return [list(column) for column in zip(*rows)] if rows else [[] for column in range(numColumns)]
+
+def toInts(column, dtype=numpy.int32):
+  """Converts a list of number strings to an array"""
+  if not column:
+    return numpy.zeros(0, dtype=dtype)
+
+  values = numpy.fromstring(' '.join(column), dtype=numpy.int64, sep=' ')
+  if len(values) != len(column):
+    raise ValueError("Not all numbers: " + ' '.join(column[:5]) + " ...")
+
+  return values.astype(dtype)
+
+def toChars(column):
+  """Converts a list of one character strings to a uint8 array. Anything
+  longer or empty is given as '?'"""
+  chars = ''.join(column)
+  if len(chars) != len(column):
+    chars = ''.join(value if len(value) == 1 else '?' for value in column)
+
+  return numpy.frombuffer(chars, dtype=numpy.uint8)
+
+def runs(names):
+  """The (name, start, end) of each run of equal names"""
+  if names.count(names[0]) == len(names):
+    return [(names[0], 0, len(names))]
+
+  found = []
+  start = 0
+  for i in xrange(1, len(names)):
+    if names[i] != names[i - 1]:
+      found.append((names[start], start, i))
+      start = i
+  found.append((names[start], start, len(names)))
+
+  return found
+
+def blocks(lines, numColumns, chromeColumn):
+  """Yields (chrome, columns, rowLines) for each run of rows on one
+  chromosome in each BLOCK_ROWS lines, columns being numColumns lists of
+  strings and rowLines the lines they came from"""
+  lines = iter(lines)
+
+  while True:
+    chunk = list(itertools.islice(lines, BLOCK_ROWS))
+    if not chunk:
+      return
+
+    columns = splitLines(chunk, numColumns)
+    if not columns[0]:
+      continue
+    if len(columns[0]) != len(chunk):
+      chunk = [line for line in chunk if line.strip()]
+
+    for chrome, start, end in runs(columns[chromeColumn]):
+      yield chromeName(chrome), [column[start:end] for column in columns], chunk[start:end]
+
+def readCalls(lines):
+  """Called reads: chrome, pos, call and N2, MY14 and other read counts"""
+  for chrome, columns, rowLines in blocks(lines, 6, 0):
+    yield Calls(chrome, toInts(columns[1]), toChars(columns[2]), toInts(columns[3]), toInts(columns[4]), toInts(columns[5]))
+
+def readMutations(lines):
+  """A mutations table: name, type, strain, chrome, pos, N2 base, MY14 base"""
+  for chrome, columns, rowLines in blocks(lines, 7, 3):
+    yield Mutations(chrome, columns[0], columns[1], columns[2], toInts(columns[4]), columns[5], columns[6])
+
+def readPileup(lines):
+  """An mpileup: chrome, pos, reference base, depth, bases, qualities"""
+  for chrome, columns, rowLines in blocks(lines, 6, 0):
+    yield Pileup(chrome, toInts(columns[1]), columns[2], toInts(columns[3]), columns[4], columns[5])
+
+def readPositions(lines, withLines=False):
+  """A filter or candidate sites file, or any file that starts with chrome
+  and pos. With withLines, yields (block, the block's lines)"""
+  for chrome, columns, rowLines in blocks(lines, 2, 0):
+    block = Positions(chrome, toInts(columns[1]))
+    yield (block, rowLines) if withLines else block
+
+def readPreds(lines):
+  """Either of predict's formats, a block per run of regions on one
+  chromosome. With TABLE_PRINT set predict writes chrome, the breakpoint's
+  lower and upper ends, pred and the stats, and a region runs from the
+  previous region's upper breakpoint, or 0, to its own lower one. Rows with
+  fewer than the five stats get empty ones. By default it writes strain,
+  chrome, start, end, size, the stats and the previous, own and next pred,
+  and a region runs from its start to its end. A header line, or any other
+  line that is neither, is skipped"""
+  rows = []
+  for line in lines:
+    row = line.rstrip('\r\n').split('\t')
+
+    if len(row) >= 4 and row[3] in ('N', 'M', 'H'):
+      rows.append((row[0], int(row[1]), int(row[2]), row[3], tuple((row[4:9] + [''] * 5)[:5]), False))
+    elif len(row) >= 13 and row[2].replace(',', '').isdigit():
+      end = int(row[3].replace(',', ''))
+      rows.append((row[1], int(row[2].replace(',', '')), end, row[12], (row[5], row[6], row[7], row[8], row[10]), True))
+
+  if not rows:
+    return
+
+  for chrome, start, end in runs([row[0] for row in rows]):
+    chromeRows = rows[start:end]
+    firsts = numpy.array([row[1] for row in chromeRows], dtype=numpy.int64)
+    seconds = numpy.array([row[2] for row in chromeRows], dtype=numpy.int64)
+
+    if chromeRows[0][5]:
+      starts, ends, uppers = firsts, seconds, seconds
+    else:
+      starts, ends, uppers = numpy.concatenate(([0], seconds[:-1])), firsts, seconds
+
+    yield Preds(chromeName(chrome), starts, ends, uppers, [row[3] for row in chromeRows], [row[4] for row in chromeRows])
@@ -0,0 +1,112 @@
+from array import array
+
+class Sites(object):
+  """Columnar store of the called sites on one chromosome. Calls are kept
+  one byte per site in a bytearray and positions in a typed int array. When
+  uCounts is kept (as predict does) it holds the number of U sites skipped
+  before each site.
+
+  Indexing a site gives a (call, pos, uCount) tuple. Slicing gives a view onto
+  the same columns instead of copying them."""
+
+  __slots__ = ('calls', 'positions', 'uCounts', 'start', 'end')
+
+  def __init__(self, uCounts=True, columns=None, start=0, end=None):
+    if columns:
+      self.calls, self.positions, self.uCounts = columns
+    else:
+      self.calls = bytearray()
+      self.positions = array('i')
+      self.uCounts = array('i') if uCounts else None
+
+    self.start = start
+    self.end = len(self.calls) if end is None else end
+
+  def append(self, call, pos, uCount=0):
+    """Adds a site to the end. Only for the full store, not for views"""
+    self.calls.append(call)
+    self.positions.append(pos)
+    if self.uCounts is not None:
+      self.uCounts.append(uCount)
+    self.end = self.end + 1
+
+  def extend(self, calls, positions, uCounts=None):
+    """Adds a block of sites to the end, given as numpy arrays of call
+    characters, positions and U counts. Only for the full store"""
+    self.calls.extend(calls.astype('uint8').tostring())
+    self.positions.fromstring(positions.astype('int32').tostring())
+    if self.uCounts is not None:
+      self.uCounts.fromstring(uCounts.astype('int32').tostring())
+    self.end = self.end + len(calls)
+
+  def __len__(self):
+    return self.end - self.start
+
+  def index(self, i):
+    """Maps an index into this view to an index into the columns"""
+    if i < 0:
+      i = i + self.end - self.start
+    if i < 0 or i >= self.end - self.start:
+      raise IndexError("site index out of range")
+    return self.start + i
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      start, end, step = i.indices(self.end - self.start)
+      return Sites(columns=(self.calls, self.positions, self.uCounts), start=self.start + start, end=self.start + max(start, end))
+
+    i = self.index(i)
+    return (chr(self.calls[i]), self.positions[i], self.uCounts[i] if self.uCounts is not None else 0)
+
+  def __iter__(self):
+    for i in xrange(self.end - self.start):
+      yield self[i]
+
+  def call(self, i):
+    return chr(self.calls[self.index(i)])
+
+  def pos(self, i):
+    return self.positions[self.index(i)]
+
+  def uCount(self, i):
+    return self.uCounts[self.index(i)]
+
+  def callView(self):
+    """The calls of this view as a read only buffer of characters, without copying"""
+    return buffer(self.calls, self.start, self.end - self.start)
+
+class Quals(object):
+  """Columnar store of pileup quality strings on one chromosome. The strings
+  are packed end to end in one bytearray with an array of offsets, alongside
+  a typed array of positions"""
+
+  __slots__ = ('positions', 'offsets', 'quals')
+
+  def __init__(self):
+    self.positions = array('i')
+    self.offsets = array('l', [0])
+    self.quals = bytearray()
+
+  def append(self, pos, qual):
+    self.positions.append(pos)
+    self.quals.extend(qual)
+    self.offsets.append(len(self.quals))
+
+  def extend(self, positions, quals):
+    """Adds a block of sites given as a numpy array of positions and a list
+    of quality strings"""
+    self.positions.fromstring(positions.astype('int32').tostring())
+    for qual in quals:
+      self.quals.extend(qual)
+      self.offsets.append(len(self.quals))
+
+  def __len__(self):
+    return len(self.positions)
+
+  def pos(self, i):
+    return self.positions[i]
+
+  def qual(self, i):
+    """The quality string for site i as a read only buffer, without copying"""
+    start = self.offsets[i]
+    return buffer(self.quals, start, self.offsets[i + 1] - start)
@@ -1,32 +1,280 @@
-import scipy.stats
+import os
+import re
+import math
+import gzip
+import json
+import hashlib
+import bgzf
+from array import array
+
+#Chance that a read is N in a bin that is really M, H or N
+M_RATE = 0.01
+H_RATE = 0.5
+N_RATE = 0.99
+
+#Cutoffs for bin sizes 0 to TABLE_SIZE are computed once and cached on disk.
+#Bump TABLE_VERSION whenever the way they are computed changes.
+TABLE_SIZE = 2000
+TABLE_VERSION = 1
+
+CACHE_DIR = os.environ.get("CONVERSION_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".conversion"))
+
+#Plain files are read this much at a time when looking for chromosomes
+SCAN_SIZE = 1 << 20
+
+#Flat array of (mThresh, nThresh) pairs indexed by bin size, loaded on first use
+cutoffTable = None
+
+def isCompressed(fileName):
+  return fileName.endswith(".gz") or fileName.endswith(".bgz")
+
+def openFile(fileName, mode='r'):
+  """Opens a file, reading or writing it compressed if its name ends in .gz
+  or .bgz. bgzip files, whatever their name, are read with their blocks
+  inflated on a pool of threads. Files ending in .bgz are written as bgzip,
+  ones ending in .gz as plain gzip"""
+  if not isCompressed(fileName):
+    return open(fileName, mode)
+
+  if 'r' in mode:
+    if bgzf.isBgzf(fileName):
+      return bgzf.BgzfReader(fileName)
+  elif fileName.endswith(".bgz"):
+    return bgzf.BgzfWriter(fileName)
+
+  return gzip.open(fileName, mode + 'b' if 'b' not in mode else mode)
+
+def isSeekable(fileName):
+  """Whether places in the file can be read without reading all before them,
+  true of plain and bgzip files but not plain gzip ones"""
+  return not isCompressed(fileName) or bgzf.isBgzf(fileName)
+
+def chunks(fileName, start=0, end=None):
+  """Yields (offset, data) for the file from start up to end, cut anywhere.
+  Offsets are byte offsets, or virtual offsets for bgzip files. Either way
+  offset + i is the place of data[i]"""
+  if isCompressed(fileName):
+    with bgzf.BgzfReader(fileName) as reader:
+      for chunk in reader.blocks(start, end):
+        yield chunk
+    return
+
+  with open(fileName, 'rb') as inFile:
+    inFile.seek(start)
+    offset = start
+    while end is None or offset < end:
+      data = inFile.read(SCAN_SIZE if end is None else min(SCAN_SIZE, end - offset))
+      if not data:
+        return
+      yield offset, data
+      offset = offset + len(data)
+
+def readRange(fileName, start=0, end=None):
+  """The lines of the file from start up to end"""
+  return bgzf.lines(data for offset, data in chunks(fileName, start, end))
+
+def chromeBlocks(fileName, column):
+  """Finds where each chromosome's lines are in a file that keeps each
+  chromosome's lines together, the chromosome being the given column of a
+  line. Returns a list of (chrome, start, end) in file order, chrome as
+  written and end None for the last, or None if a chromosome turns up in two
+  places. Kept in the cache by the file's mtime and size, so each file is
+  only scanned once"""
+  info = os.stat(fileName)
+  path = os.path.join(CACHE_DIR, "blocks", hashlib.sha1(os.path.abspath(fileName) + '\t' + str(column)).hexdigest() + ".json")
+
+  try:
+    with open(path) as cacheFile:
+      cached = json.load(cacheFile)
+    if cached["mtime"] == info.st_mtime and cached["size"] == info.st_size:
+      return cached["blocks"] and [tuple(block) for block in cached["blocks"]]
+  except (IOError, ValueError, KeyError):
+    pass
+
+  blocks = scanChromeBlocks(fileName, column)
+
+  #Not being able to write the cache only costs a scan next time
+  try:
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+
+    tempPath = "{}.{}".format(path, os.getpid())
+    with open(tempPath, 'w') as cacheFile:
+      json.dump({"mtime": info.st_mtime, "size": info.st_size, "blocks": blocks}, cacheFile)
+    os.rename(tempPath, path)
+  except (IOError, OSError):
+    pass
+
+  return blocks
+
+def scanChromeBlocks(fileName, column):
+  """Reads through the file for chromeBlocks. Each chunk is first checked to
+  be all on the chromosome before it by counting the lines that have it,
+  and only chunks where that fails are read line by line"""
+  starts = []
+  #Matches a line whose chromosome is the one the pattern was made for
+  patterns = {}
+
+  def lineChrome(text, first, last):
+    line = text[first:last].rstrip('\r')
+    fields = line.split('\t', column + 1)
+    return fields[column] if line and len(fields) > column else None
+
+  def allOn(chrome, text, cut):
+    #Counting line starts is much faster than the regex, and covers pileups
+    if column == 0:
+      return text.startswith(chrome + '\t') and text.count('\n' + chrome + '\t', 0, cut) == text.count('\n', 0, cut) - 1
+
+    if chrome not in patterns:
+      patterns[chrome] = re.compile('^' + '[^\t\n]*\t' * column + re.escape(chrome) + '(?:\t|\r?$)', re.M)
+    return len(patterns[chrome].findall(text, 0, cut)) == text.count('\n', 0, cut)
+
+  #The unfinished line at the end of the last chunk and where it starts
+  rest = ''
+  restStart = 0
+  for offset, data in chunks(fileName):
+    text = rest + data
+    cut = text.rfind('\n') + 1
+
+    #The place of text[i]
+    place = lambda i: restStart + i if i < len(rest) else offset + i - len(rest)
+
+    if cut and not (starts and allOn(starts[-1][0], text, cut)):
+      first = 0
+      while first < cut:
+        last = text.find('\n', first)
+        chrome = lineChrome(text, first, last)
+        if chrome is not None and (not starts or chrome != starts[-1][0]):
+          starts.append((chrome, place(first)))
+        first = last + 1
+
+    restStart = place(cut)
+    rest = text[cut:]
+
+  if rest.strip():
+    chrome = lineChrome(rest, 0, len(rest.rstrip('\n')))
+    if chrome is not None and (not starts or chrome != starts[-1][0]):
+      starts.append((chrome, restStart))
+
+  chromes = [chrome for chrome, start in starts]
+  if len(set(chromes)) != len(chromes):
+    return None
+
+  ends = [start for chrome, start in starts[1:]] + [None]
+  return [(chrome, start, end) for (chrome, start), end in zip(starts, ends)]
 
 def cutoffs(binSize):
   """Figure out cutoffs for the given bin size.
   Returns a tuple of cutoffs. Less than the first number
   means the bin is most likely M, greater than the second
-  number means the bin is most likely N, in between is 
+  number means the bin is most likely N, in between is
   heterozygous"""
-  
-  binSize = int(binSize)  
-  #Binomial for number of Ns in bin
-  mProb = scipy.stats.binom.pmf(range(binSize+1),binSize,0.01)
-  hProb = scipy.stats.binom.pmf(range(binSize+1),binSize,0.5)
-  nProb = scipy.stats.binom.pmf(range(binSize+1),binSize,0.99)
-  
-  mThresh = -1
-  nThresh = binSize+1
-
-  for i in range(binSize+1):
-    if(hProb[i] > mProb[i]):
-      mThresh = i
+
+  binSize = int(binSize)
+  table = getCutoffTable(binSize)
+
+  return table[2 * binSize], table[2 * binSize + 1]
+
+def getCutoffTable(maxBinSize=TABLE_SIZE):
+  """Returns the flat cutoff table, covering at least bin sizes 0 to maxBinSize.
+  The table is read from the cache (or built and saved there) the first time,
+  and extended in memory for anything larger than TABLE_SIZE"""
+  global cutoffTable
+
+  if cutoffTable is None:
+    cutoffTable = loadCutoffTable()
+
+  known = len(cutoffTable) / 2 - 1
+  if maxBinSize > known:
+    #Grow by at least double so deep sites don't rebuild a row at a time
+    cutoffTable.extend(buildCutoffs(known + 1, max(maxBinSize, 2 * known)))
+
+  return cutoffTable
+
+def cachePath():
+  return os.path.join(CACHE_DIR, "cutoffs.v{}.{}.{}-{}-{}.bin".format(TABLE_VERSION, TABLE_SIZE, M_RATE, H_RATE, N_RATE))
+
+def loadCutoffTable():
+  """Reads the cutoff table for bin sizes 0 to TABLE_SIZE from the cache,
+  building and caching it if it is not there yet"""
+  path = cachePath()
+  table = array('d')
+
+  try:
+    with open(path, 'rb') as tableFile:
+      table.fromfile(tableFile, 2 * (TABLE_SIZE + 1))
+    return table
+  except (IOError, EOFError):
+    pass
+
+  table = buildCutoffs(0, TABLE_SIZE)
+
+  #Not being able to write the cache only costs a rebuild next time
+  try:
+    if not os.path.isdir(CACHE_DIR):
+      os.makedirs(CACHE_DIR)
+
+    #Write then rename so another script never reads half a table
+    tempPath = "{}.{}".format(path, os.getpid())
+    with open(tempPath, 'wb') as tableFile:
+      table.tofile(tableFile)
+    os.rename(tempPath, path)
+  except (IOError, OSError):
+    pass
+
+  return table
+
+def buildCutoffs(first, last):
+  """Computes the cutoffs for bin sizes first to last in log space.
+  Returns them as a flat array of (mThresh, nThresh) pairs.
+
+  For a bin size, mThresh is the first number of Ns where H is more likely
+  than M (-1 if there is none), and nThresh is the last number of Ns where H
+  is more likely than N (binSize + 1 if there is none)"""
+  import numpy
+
+  binSizes = numpy.arange(first, last + 1)
+
+  #Log of the binomial pmf of each count, leaving out the binomial
+  #coefficient since it is the same for every rate being compared
+  def logProb(counts, rate):
+    return counts * math.log(rate) + (binSizes - counts) * math.log(1.0 - rate)
+
+  def hWins(counts, rate):
+    valid = (counts >= 0) & (counts <= binSizes)
+    return valid & (logProb(counts, H_RATE) > logProb(counts, rate))
+
+  def crossing(rate):
+    """The count where H and rate are equally likely. The log-likelihoods
+    are linear in the count, so with M_RATE < H_RATE < N_RATE H wins above
+    it against M and below it against N"""
+    slope = math.log(H_RATE / rate) - math.log((1.0 - H_RATE) / (1.0 - rate))
+    return binSizes * (math.log((1.0 - rate) / (1.0 - H_RATE)) / slope)
+
+  #Start from the crossings, then step over any count where rounding puts
+  #them on the wrong side of the comparison made count by count
+  mThresh = numpy.clip(numpy.floor(crossing(M_RATE)).astype(int) + 1, 0, binSizes + 1)
+  while True:
+    back = hWins(mThresh - 1, M_RATE)
+    ahead = (mThresh <= binSizes) & ~hWins(mThresh, M_RATE)
+    if not (back.any() or ahead.any()):
+      break
+    mThresh += ahead.astype(int) - back.astype(int)
+
+  nThresh = numpy.clip(numpy.ceil(crossing(N_RATE)).astype(int) - 1, -1, binSizes)
+  while True:
+    ahead = hWins(nThresh + 1, N_RATE)
+    back = (nThresh >= 0) & ~hWins(nThresh, N_RATE)
+    if not (back.any() or ahead.any()):
       break
+    nThresh += ahead.astype(int) - back.astype(int)
 
-  for i in range(binSize, -1, -1):
-    if(hProb[i] > nProb[i]):
-      nThresh = i
-      break;
+  mThresh = numpy.where(mThresh <= binSizes, mThresh, -1)
+  nThresh = numpy.where(nThresh >= 0, nThresh, binSizes + 1)
 
-  return float(mThresh), float(nThresh)
+  table = array('d')
+  table.fromstring(numpy.column_stack((mThresh, nThresh)).astype(float).tostring())
+  return table
 
 if __name__ == '__main__':
-  print cutoffs(2)
\ No newline at end of file
+  print cutoffs(2)
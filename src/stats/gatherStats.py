@@ -7,109 +7,175 @@ djc 4/24/14
 import math
 import os
 import sys
-import csv
+import argparse
+import numpy
 from collections import defaultdict
-
-#Share these arrays to store our stats
-outliers = []
-expSeqErrors = []
-expBarCodeErrors = []
-
-def gather(bcRateFileName, outFilename):
+from multiprocessing import Pool
+
+#The site stores are shared with the pipeline scripts in main
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'main'))
+import siteStore
+import callStore
+import predIndex
+import records
+import profiling
+import util
+
+#Log of the chance a base is right for each phred score, indexed by the
+#quality character minus 33. A score of 0 is never right.
+logRight = [float("-inf")] + [math.log(1.0 - math.pow(10.0, score / -10.0)) for score in range(1, 94)]
+logRightArray = numpy.array(logRight)
+
+def gather(bcRateFileName, outFilename, jobs=1):
 	"""Gathers the data needed for my stats project!
 	# of outliers
 	expected # of sequencing errors
 	expected # of barcode errors"""
 
-	with open(bcRateFileName) as bcFile, open(outFilename, 'w') as outFile:
+	manifest = makeManifest(bcRateFileName)
+
+	if jobs > 1:
+		pool = Pool(jobs)
+		results = pool.imap(handleManifestSample, manifest)
+	else:
+		pool = None
+		results = (handleManifestSample(sample) for sample in manifest)
+
+	outliers = []
+	expSeqErrors = []
+	expBarCodeErrors = []
+
+	try:
+		with profiling.stage("gatherSamples") as stage:
+			stage.read(*[fileName for sample in manifest for fileName in sample[:3]])
+			stage.count(len(manifest))
+
+			maxCalls = 0.0
+			#Results come back in manifest order
+			for numCalls, sampleOutliers, sampleSeqErrors, sampleBarCodeErrors in results:
+				outliers.extend(sampleOutliers)
+				expSeqErrors.extend(sampleSeqErrors)
+				expBarCodeErrors.extend(sampleBarCodeErrors)
+
+				if(numCalls > maxCalls):
+					maxCalls = numCalls
+	finally:
+		if pool:
+			pool.close()
+			pool.join()
+
+	#print maxCalls
+	#Now we have all stats, write em out!
+	with util.openFile(outFilename, 'w') as outFile:
+		outFile.write('list(n={},\noutliers=c({}),\nexpSeqErrors=c({}),\nexpBarcodeErrors=c({}))'.format(len(outliers), ", ".join(outliers), ", ".join(expSeqErrors), ", ".join(expBarCodeErrors)))
 
-		#we needs the pileup data, the calls, and the predictions
-		callDir = "calls"
-		pileDir = "piles"
-		predDir = "preds"
+def makeManifest(bcRateFileName):
+	"""Pairs each line of the barcode rate file with a sample's call, pileup
+	and pred files, taking each directory's files in sorted order.
+	Returns a list of (callFile, pileFile, predFile, bcRate) tuples"""
 
-		callFilenames = iter(os.listdir(callDir))
-		pileFilenames = iter(os.listdir(pileDir))
-		predFilenames = iter(os.listdir(predDir))
+	#we needs the pileup data, the calls, and the predictions
+	callDir = "calls"
+	pileDir = "piles"
+	predDir = "preds"
 
-		#The entries in bcFile and all the call, pileup, pred files should be
-		#synchronized
+	with open(bcRateFileName) as bcFile:
+		bcRates = [float(row) for row in bcFile]
 
-		maxCalls = 0.0
-		#So each step here represents one sample
-		for row in bcFile:
-			currCall = os.path.join(callDir, callFilenames.next())
-			currPile = os.path.join(pileDir, pileFilenames.next())
-			currPred = os.path.join(predDir, predFilenames.next())
+	#The entries in bcFile and all the call, pileup, pred files should be
+	#synchronized
+	sampleFiles = []
+	for sampleDir in (callDir, pileDir, predDir):
+		#Binary call stores and pred indexes stand in for or sit beside the
+		#file they were made from
+		fileNames = sorted(fileName for fileName in os.listdir(sampleDir) if not callStore.isStore(fileName) and not predIndex.isIndex(fileName))
+		if len(fileNames) < len(bcRates):
+			raise ValueError("{} has {} files for {} barcode rates".format(sampleDir, len(fileNames), len(bcRates)))
 
-			numCalls = handleSample(currCall, currPile, currPred, float(row))
+		sampleFiles.append([os.path.join(sampleDir, fileName) for fileName in fileNames])
 
-			if(numCalls > maxCalls):
-				maxCalls = numCalls
+	#So each entry here represents one sample
+	return zip(sampleFiles[0], sampleFiles[1], sampleFiles[2], bcRates)
 
-		#print maxCalls
-		#Now we have all stats, write em out!
-		outFile.write('list(n={},\noutliers=c({}),\nexpSeqErrors=c({}),\nexpBarcodeErrors=c({}))'.format(len(outliers), ", ".join(outliers), ", ".join(expSeqErrors), ", ".join(expBarCodeErrors)))
+def handleManifestSample(sample):
+	return handleSample(*sample)
 
 def handleSample(callFilename, pileFilename, predFilename, bcRate):
-	"""Gathers the stats for the given sample"""
+	"""Gathers the stats for the given sample. Returns the most calls
+	in a region along with this sample's lists of outliers, expected
+	sequencing errors and expected barcode errors"""
 
 	print callFilename
 
-	with open(callFilename) as callFile, open(pileFilename) as pileFile, open(predFilename) as predFile:
+	with util.openFile(callFilename) as callFile, util.openFile(pileFilename) as pileFile, util.openFile(predFilename) as predFile, profiling.stage("loadSample") as stage:
+		stage.read(callFilename, pileFilename, predFilename)
 		#load each file into memory and sort by chromosome
-        	callChromes = defaultdict(list)
-		pileChromes = defaultdict(list)
+		#calls and pileups go into columnar stores, there are only a few predictions
+        	callChromes = defaultdict(lambda: siteStore.Sites(uCounts=False))
+		pileChromes = defaultdict(siteStore.Quals)
 		predChromes = defaultdict(list)
 
-		callReader = csv.reader(callFile, delimiter='\t')
-		pileReader = csv.reader(pileFile, delimiter='\t')
-		predReader = csv.reader(predFile, delimiter='\t')
-
 		#Only care about the call itself
-		for row in callReader:
-			callChromes[row[0]].append((int(row[1]), row[2])) 
+		#Use the binary store of the calls if there is one
+		store = callStore.openCalls(callFilename)
+		if store:
+			with store:
+				for chrome in store.chromes:
+					callChromes[chrome] = store.sites(chrome)
+		else:
+			for block in records.readCalls(callFile):
+				callChromes[block.chrome].extend(block.call, block.pos)
 
 		#Only care about quality scores
-		for row in pileReader:
-			pileChromes[row[0]].append((int(row[1]), row[5]))
+		for block in records.readPileup(pileFile):
+			pileChromes[block.chrome].extend(block.pos, block.quals)
 
-		#Need first 4 rows
-		#Skip first row
-		first = True
-		for row in predReader:
-			if first:
-				first = False
-				continue
+		#Need each region's end, the end of the breakpoint after it and the
+		#prediction. The header line is skipped
+		for block in records.readPreds(predFile):
+			predChromes[block.chrome].extend(zip(block.end.tolist(), block.upper.tolist(), block.pred))
 
-			predChromes[row[0]].append((int(row[1]), int(row[2]), row[3]))
+		stage.count(sum(len(calls) for calls in callChromes.values()) + sum(len(piles) for piles in pileChromes.values()))
 
-		#Now handle each chromosome
+	#Now handle each chromosome
+	with profiling.stage("handleChromosomes") as stage:
 		maxCalls = 0.0
+		stats = ([], [], [])
 		for chrome in predChromes.keys():
-			numCalls = handleChromosome(callChromes[chrome], pileChromes[chrome], predChromes[chrome], bcRate)
+			numCalls = handleChromosome(callChromes[chrome], pileChromes[chrome], predChromes[chrome], bcRate, stats)
 			if(numCalls > maxCalls):
 				maxCalls = numCalls
 
-		return maxCalls
+		stage.count(sum(len(preds) for preds in predChromes.values()))
 
-def handleChromosome(calls, piles, preds, bcRate):
-	"""Walks through prediction file and gathers stats for each region"""
+	return (maxCalls,) + stats
+
+def handleChromosome(calls, piles, preds, bcRate, stats):
+	"""Walks through prediction file and gathers stats for each region,
+	adding them to the stats tuple of outlier, sequencing error and barcode
+	error lists"""
+
+	outliers, expSeqErrors, expBarCodeErrors = stats
 
 	#We will need to walk through calls and pileups just once
+	#currCall and currPile are the indexes of the sites being looked at,
+	#which stay on the last site once the end is reached
 	callPos = 0
 	callLength = len(calls)
 	pileLength = len(piles)
 	pilePos = 0	
 
-	currCall = calls[0]
-	currPile = piles[0]
+	currCall = 0
+	currPile = 0
 
 	#The chance of not having a barcode error
 	chanceNoBc = 1.0 - bcRate
 
 	regionStart = 0
 
+	#Sequencing error chance for every pileup site on the chromosome at once
+	seqWrong = chanceWrongAll(piles).tolist()
+
 	for region in preds:
 		pred = region[2]
 		if(pred == "H"): #don't care about het, so keep going
@@ -126,36 +192,37 @@ def handleChromosome(calls, piles, preds, bcRate):
 		#print end
 
 		#Catch the iters up to the current region
-		while(currCall[0] < regionStart):
+		while(calls.pos(currCall) < regionStart):
 			callPos = callPos + 1
 
 			if(callPos < callLength):
-				currCall = calls[callPos]
+				currCall = callPos
 			else:
 				break
 
-		while(currPile[0] < regionStart):
+		while(piles.pos(currPile) < regionStart):
 			pilePos = pilePos + 1
 
 			if(pilePos < pileLength):
-				currPile = piles[pilePos]
+				currPile = pilePos
 			else:
 				break
 
 		#Now go through each and gather the stats
 		numCalls = 0.0
-		while(currCall[0] <= regionEnd and numCalls < 1000.0):
-			#print currCall[0]
-			if(currCall[1] != "U"):
+		while(calls.pos(currCall) <= regionEnd and numCalls < 1000.0):
+			#print calls.pos(currCall)
+			call = calls.call(currCall)
+			if(call != "U"):
 				numCalls = numCalls + 1.0
 
-			if(currCall[1] != "U" and currCall[1] != pred):
+			if(call != "U" and call != pred):
 				outlierCount = outlierCount + 1
 			
 			callPos = callPos + 1
 
 			if(callPos < callLength):				
-				currCall = calls[callPos]
+				currCall = callPos
 			else:
 				break
 
@@ -163,24 +230,24 @@ def handleChromosome(calls, piles, preds, bcRate):
 
 		sites = 0
 
-		while(currPile[0] <= regionEnd and sites < 1000):
+		while(piles.pos(currPile) <= regionEnd and sites < 1000):
 			sites = sites + 1
 			#chance that the base was sequenced incorrectly, divide by 3 that it was opposite base
-			qualScores = currPile[1]
-			expSeqCount = expSeqCount + (chanceWrong(qualScores) / 3.0)
+			expSeqCount = expSeqCount + (seqWrong[currPile] / 3.0)
 
 			#The chance of having a barcode error is 1 minus the chance that all reads did not have a barcode error
 			#Divide by 2 because it might be a barcode error but still have the same base
-			chanceBc = (1.0 - pow(chanceNoBc, len(qualScores))) / 2.0
+			numReads = piles.offsets[currPile + 1] - piles.offsets[currPile]
+			chanceBc = (1.0 - pow(chanceNoBc, numReads)) / 2.0
 			#print chanceNoBc
-			#print len(qualScores)
+			#print numReads
 			#print chanceBc
 			expBarcode = expBarcode + chanceBc
 
 			pilePos = pilePos + 1
 
 			if(pilePos < pileLength):
-				currPile = piles[pilePos]
+				currPile = pilePos
 			else:
 				break
 
@@ -200,14 +267,36 @@ def handleChromosome(calls, piles, preds, bcRate):
 def chanceWrong(qualStr):
 	"""Returns the chance that this base was sequence incorrectly based on phred scores of reads"""
 	
-	chanceRight = 1.0
+	logChanceRight = 0.0
 	
 	for char in qualStr:
-		score = ord(char) - 33
-		chanceRight = chanceRight * (1.0 - math.pow(10.0, score / -10.0))
+		logChanceRight = logChanceRight + logRight[ord(char) - 33]
+
+	return 1.0 - math.exp(logChanceRight)
 
-	return 1.0 - chanceRight
+def chanceWrongAll(piles):
+	"""Same as chanceWrong, for every site in a chromosome's pileup quality store.
+	All the quality strings are looked up in logRight in one go and summed
+	per site, returned as an array by site"""
+
+	offsets = numpy.frombuffer(piles.offsets, dtype=piles.offsets.typecode)
+	scores = numpy.frombuffer(piles.quals, dtype=numpy.uint8).astype(numpy.intp) - 33
+	logs = logRightArray[scores]
+
+	#reduceat can't sum an empty string, so only pass it the sites with reads
+	logChanceRight = numpy.zeros(len(piles))
+	hasReads = offsets[1:] > offsets[:-1]
+	if hasReads.any():
+		logChanceRight[hasReads] = numpy.add.reduceat(logs, offsets[:-1][hasReads])
+
+	return 1.0 - numpy.exp(logChanceRight)
 
 if __name__ == '__main__':
-	gather(*sys.argv[1:])
+	parser = argparse.ArgumentParser()
+	parser.add_argument("bcRateFile", help="the file of barcode error rates, one line per sample")
+	parser.add_argument("outputFile", help="the file to save the stats to")
+	parser.add_argument("-j", "--jobs", type=int, default=1, help="number of samples to handle at once")
+	args = parser.parse_args()
+
+	profiling.run("gatherStats", gather, args.bcRateFile, args.outputFile, args.jobs)
 	